@@ -0,0 +1,249 @@
+"""
+Cold start benchmark for the Lambda handler.
+
+Each run starts a fresh interpreter, times `import lambda_function`, then times the
+first direct message through `handle_message` with Slack, S3 and the LLM stubbed
+out. Real sockets are blocked throughout, so any network call at import time or
+outside the stubs fails the run. The time spent in each stage of the first event
+is reported from the telemetry spans it records.
+
+    python bench/cold_start.py --runs 5 --max-import-s 1.5
+
+Exits non-zero if a threshold is exceeded or a heavy library is loaded at import.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Libraries that must only load once an event actually needs them
+HEAVY_MODULES = ["litellm", "pdfminer", "trafilatura", "youtube_transcript_api"]
+BENCH_ENV = {
+    "SLACK_BOT_TOKEN": "xoxb-bench",
+    "SLACK_SIGNING_SECRET": "bench",
+    "S3_BUCKET_NAME": "bench-bucket",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "SLACK_UPDATE_INTERVAL_S": "0",
+    "LITELLM_LOCAL_MODEL_COST_MAP": "True",
+    "LOG_LEVEL": "WARNING",
+    "POWERTOOLS_LOG_LEVEL": "WARNING",
+}
+SLACK_RESPONSES = {
+    "auth.test": {"user_id": "UBOT", "team_id": "TBENCH"},
+    "users.info": {"user": {"id": "UBENCH", "real_name": "Bench User"}},
+    "conversations.history": {
+        "messages": [
+            {
+                "type": "message",
+                "user": "UBENCH",
+                "text": "hi",
+                "ts": "1.0",
+                "blocks": [
+                    {
+                        "type": "rich_text",
+                        "elements": [
+                            {
+                                "type": "rich_text_section",
+                                "elements": [{"type": "text", "text": "hi"}],
+                            }
+                        ],
+                    }
+                ],
+            }
+        ],
+        "has_more": False,
+    },
+    "chat.postMessage": {"ts": "2.0"},
+}
+
+
+def _block_network(*args, **kwargs):
+    raise RuntimeError("Network access during the cold start benchmark")
+
+
+class FakeS3:
+    """An empty bucket: every read misses and every write succeeds."""
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def get_object(self, **kwargs):
+        raise self.exceptions.NoSuchKey(kwargs["Key"])
+
+    def put_object(self, **kwargs):
+        return {}
+
+    def delete_objects(self, **kwargs):
+        return {}
+
+    def get_paginator(self, name):
+        class Paginator:
+            def paginate(self, **kwargs):
+                return [{}]
+
+        return Paginator()
+
+
+def child() -> None:
+    socket.socket.connect = _block_network  # type: ignore
+    sys.path.insert(0, ROOT)
+
+    start = time.perf_counter()
+    import lambda_function
+
+    import_s = time.perf_counter() - start
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    import s3_cache
+    import session
+    import telemetry
+    from slack_sdk import WebClient
+    from slack_sdk.web import SlackResponse
+    from slack_sdk.web.async_client import AsyncWebClient
+    from slack_sdk.web.async_slack_response import AsyncSlackResponse
+
+    def api_call(self, api_method, **kwargs):
+        data = {"ok": True, **SLACK_RESPONSES.get(api_method, {})}
+        return SlackResponse(
+            client=self,
+            http_verb="POST",
+            api_url=api_method,
+            req_args={},
+            data=data,
+            headers={},
+            status_code=200,
+        )
+
+    async def async_api_call(self, api_method, **kwargs):
+        data = {"ok": True, **SLACK_RESPONSES.get(api_method, {})}
+        return AsyncSlackResponse(
+            client=self,
+            http_verb="POST",
+            api_url=api_method,
+            req_args={},
+            data=data,
+            headers={},
+            status_code=200,
+        )
+
+    real_completion = session.completion
+    real_acompletion = session.acompletion
+    WebClient.api_call = api_call  # type: ignore
+    AsyncWebClient.api_call = async_api_call  # type: ignore
+    s3_cache._s3_client = FakeS3()
+    # Still imports litellm, so its deferred import counts towards the first event
+    session.completion = lambda **kwargs: real_completion(
+        **kwargs,
+        custom_llm_provider="openai",
+        mock_response="Hello from the benchmark.",
+    )
+    session.acompletion = lambda **kwargs: real_acompletion(
+        **kwargs,
+        custom_llm_provider="openai",
+        mock_response="Hello from the benchmark.",
+    )
+
+    body = {
+        "team_id": "TBENCH",
+        "authorizations": [{"team_id": "TBENCH", "user_id": "UBOT", "is_bot": True}],
+        "event": {
+            "type": "message",
+            "channel_type": "im",
+            "channel": "DBENCH",
+            "user": "UBENCH",
+            "text": "hi",
+            "ts": "1.0",
+        },
+    }
+    replies = []
+    start = time.perf_counter()
+    with telemetry.capture() as sink:
+        lambda_function.handle_message(
+            body, lambda text=None, **kwargs: replies.append(text), logging.getLogger()
+        )
+    first_event_s = time.perf_counter() - start
+    stages_ms: dict[str, float] = {}
+    for m in sink.measurements:
+        if m.unit == telemetry.MILLISECONDS:
+            stages_ms[m.name] = stages_ms.get(m.name, 0.0) + m.value
+
+    print(
+        json.dumps(
+            {
+                "import_s": import_s,
+                "first_event_s": first_event_s,
+                "stages_ms": stages_ms,
+                "heavy_at_import": loaded,
+                "errors": [r for r in replies if r and "Something went wrong" in r],
+            }
+        )
+    )
+
+
+def run_once() -> dict:
+    with tempfile.TemporaryDirectory() as disk_dir:
+        env = {**os.environ, **BENCH_ENV, "CACHE_DISK_DIR": disk_dir}
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child"],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-s", type=float, default=None)
+    parser.add_argument("--max-first-event-s", type=float, default=None)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return 0
+
+    results = [run_once() for _ in range(args.runs)]
+    failed = False
+    for metric, limit in (
+        ("import_s", args.max_import_s),
+        ("first_event_s", args.max_first_event_s),
+    ):
+        values = [r[metric] for r in results]
+        median = statistics.median(values)
+        print(
+            f"{metric:>14}: median {median:.3f}s "
+            f"min {min(values):.3f}s max {max(values):.3f}s"
+        )
+        if limit is not None and median > limit:
+            print(f"{metric} median {median:.3f}s is over the {limit:.3f}s limit")
+            failed = True
+    stages = sorted({name for r in results for name in r["stages_ms"]})
+    for name in stages:
+        values = [r["stages_ms"].get(name, 0.0) for r in results]
+        print(f"  {name:>26}: median {statistics.median(values):.1f}ms")
+    for r in results:
+        if r["heavy_at_import"]:
+            print(f"Loaded at import: {', '.join(r['heavy_at_import'])}")
+            failed = True
+            break
+    for r in results:
+        if r["errors"]:
+            print(f"First event failed: {r['errors'][0]}")
+            failed = True
+            break
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+PDF extraction benchmark over generated documents.
+
+Builds PDFs of several sizes with a minimal hand-written generator, then times
+`pdf_utils.extract_pdf_text` serially, in parallel and in fast mode. The page cache
+is bypassed, so every run extracts every page.
+
+    python bench/pdf_extract.py --pages 10 50 200 --workers 4
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORDS = (
+    "the quick brown fox jumps over a lazy dog while seven wizards box "
+    "jackdaws and sphinxes judge quartz vows"
+).split()
+
+
+def make_pdf(pages: int, lines_per_page: int = 45) -> bytes:
+    """A valid PDF of `pages` pages of Helvetica text, with a correct xref table."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # Page tree, once the page object numbers are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for page in range(pages):
+        lines = []
+        for line in range(lines_per_page):
+            words = [WORDS[(page * 7 + line * 3 + i) % len(WORDS)] for i in range(12)]
+            lines.append(f"({page + 1}.{line + 1} {' '.join(words)}) Tj T*")
+        stream = f"BT /F1 10 Tf 14 TL 50 770 Td {' '.join(lines)} ET".encode()
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % (len(objects))
+        )
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>".encode()
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    return bytes(out)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    os.environ.setdefault("S3_BUCKET_NAME", "bench-bucket")
+    sys.path.insert(0, ROOT)
+    import pdf_utils
+
+    pdf_utils.s3_cache.get_many = lambda *args, **kwargs: {}
+    pdf_utils.s3_cache.set_many = lambda *args, **kwargs: []
+
+    modes = [
+        ("serial", False, 1),
+        (f"{args.workers} workers", False, args.workers),
+        (f"fast, {args.workers} workers", True, args.workers),
+    ]
+    print(f"{'pages':>6} {'mode':>20} {'seconds':>8} {'pages/s':>8} {'chars':>8}")
+    for pages in args.pages:
+        # Spooled to a file, like a real download
+        with tempfile.TemporaryFile() as pdf:
+            pdf.write(make_pdf(pages))
+            for name, fast, workers in modes:
+                start = time.perf_counter()
+                text, _ = pdf_utils.extract_pdf_text(
+                    pdf, max_pages=pages, time_budget=600, fast=fast, workers=workers
+                )
+                elapsed = time.perf_counter() - start
+                print(
+                    f"{pages:>6} {name:>20} {elapsed:>8.2f} "
+                    f"{pages / elapsed:>8.1f} {len(text):>8}"
+                )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
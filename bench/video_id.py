@@ -0,0 +1,79 @@
+"""
+Micro-benchmark for YouTube video id extraction.
+
+Times `ytsubs.extract_video_id` against the previous four-regex version over a
+corpus of YouTube and other URLs, and checks that both agree on every URL.
+
+    python bench/video_id.py --repeat 2000
+"""
+
+import argparse
+import os
+import re
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=30s",
+    "https://youtube.com/watch?feature=shared&v=dQw4w9WgXcQ",
+    "https://m.youtube.com/watch?v=dQw4w9WgXcQ&list=PL1234&index=2",
+    "https://youtu.be/dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ?si=AbCdEf&t=42",
+    "https://www.youtube.com/embed/dQw4w9WgXcQ?autoplay=1",
+    "https://www.youtube.com/live/dQw4w9WgXcQ?feature=share",
+    "https://en.wikipedia.org/wiki/Rickrolling",
+    "https://github.com/shivanker/slack-bot/pull/42",
+    "https://news.ycombinator.com/item?id=40000000",
+    "https://arxiv.org/abs/1706.03762",
+    "https://docs.python.org/3/library/re.html#re.compile",
+    "https://example.com/" + "a" * 200 + "?q=" + "b" * 200,
+]
+
+
+def legacy_extract_video_id(url):
+    match = re.search(r"youtube\.com.*v=([^&]*)", url)
+    if match:
+        return match.group(1)
+    match = re.search(r"youtu\.be/([^?/]*)", url)
+    if match:
+        return match.group(1)
+    match = re.search(r"youtube\.com/embed/([^?/]*)", url)
+    if match:
+        return match.group(1)
+    match = re.search(r"youtube\.com/live/([^?/]*)", url)
+    if match:
+        return match.group(1)
+    return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+    sys.path.insert(0, ROOT)
+    from ytsubs import extract_video_id
+
+    mismatches = [
+        (url, legacy_extract_video_id(url), extract_video_id(url))
+        for url in CORPUS
+        if legacy_extract_video_id(url) != extract_video_id(url)
+    ]
+    for url, old, new in mismatches:
+        print(f"Mismatch on {url}: {old!r} before, {new!r} now")
+
+    for name, extract in (
+        ("four regexes", legacy_extract_video_id),
+        ("precompiled", extract_video_id),
+    ):
+        seconds = timeit.timeit(
+            lambda: [extract(url) for url in CORPUS], number=args.repeat
+        )
+        per_url = seconds / (args.repeat * len(CORPUS)) * 1e6
+        print(f"{name:>14}: {per_url:.2f} us per URL")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+import functools
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Any
+
+from aws_lambda_powertools import Logger
+
+from lite_llms import CONTEXT_LIMITS, TextModel
+from messages import ChatMessage, ChatRole
+
+logger = Logger()
+
+# Even models with huge windows get slow and expensive long before they fill up
+MAX_PROMPT_TOKENS = int(os.environ.get("CONTEXT_MAX_PROMPT_TOKENS", 120_000))
+# No single attachment may take more than this share of the prompt budget
+MAX_BLOCK_SHARE = float(os.environ.get("CONTEXT_MAX_BLOCK_SHARE", 0.25))
+MIN_BLOCK_TOKENS = 256
+# The local tokenizer is OpenAI's; leave headroom for other providers' tokenizers
+SAFETY_MARGIN = 0.9
+MESSAGE_OVERHEAD_TOKENS = 4
+ATTACHMENT_BLOCK = re.compile(
+    r"<(ScrapedTextFromURL|YoutubeTranscript|File)((?: [^>\n]*)?)>\n(.*?)\n</\1>",
+    re.DOTALL,
+)
+
+
+@dataclass
+class PackedContext:
+    """
+    The messages that fit a model's prompt budget, and what was left out to get there.
+
+    :param messages: System message followed by the packed history, oldest first.
+    :param prompt_tokens: Estimated size of `messages`.
+    :param budget: Prompt budget the messages were packed into.
+    :param dropped_messages: Number of older history messages left out entirely.
+    :param truncated_blocks: Attachment blocks that were trimmed to fit.
+    """
+
+    messages: list[ChatMessage]
+    prompt_tokens: int
+    budget: int
+    dropped_messages: int = 0
+    truncated_blocks: list[str] = field(default_factory=list)
+
+
+@functools.cache
+def _encoding() -> Any:
+    try:
+        import litellm  # type: ignore
+
+        # litellm ships the tiktoken BPE files, so this works without network access
+        encoding = getattr(litellm, "encoding", None)
+        if encoding is None:
+            import tiktoken  # type: ignore
+
+            encoding = tiktoken.get_encoding("cl100k_base")
+        return encoding
+    except Exception as e:
+        logger.warning(f"No local tokenizer, estimating from length: {str(e)}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def trim_middle(text: str, max_tokens: int) -> str:
+    """Keep the head and tail of `text` within roughly `max_tokens` tokens."""
+    encoding = _encoding()
+    if encoding is None:
+        tokens: Any = text
+        size = len(text) // 4 + 1
+        scale = 4
+    else:
+        tokens = encoding.encode(text, disallowed_special=())
+        size = len(tokens)
+        scale = 1
+    if size <= max_tokens:
+        return text
+    head = max_tokens * 2 // 3 * scale
+    tail = max_tokens // 3 * scale
+    join = (lambda t: t) if encoding is None else encoding.decode
+    marker = f"\n... <truncated {size - max_tokens} tokens> ...\n"
+    return join(tokens[:head]) + marker + join(tokens[len(tokens) - tail :])
+
+
+def _trim_blocks(content: str, max_block_tokens: int, truncated: list[str]) -> str:
+    def trim(match: re.Match) -> str:
+        tag, attrs, body = match.groups()
+        trimmed = trim_middle(body, max_block_tokens)
+        if trimmed is body:
+            return match.group(0)
+        truncated.append(f"<{tag}{attrs}>")
+        return f"<{tag}{attrs}>\n{trimmed}\n</{tag}>"
+
+    return ATTACHMENT_BLOCK.sub(trim, content)
+
+
+def prompt_budget(model: TextModel) -> int:
+    window, output_reserve = CONTEXT_LIMITS.get(model, (8_192, 2_048))
+    return int(min(window - output_reserve, MAX_PROMPT_TOKENS) * SAFETY_MARGIN)
+
+
+def block_budget(model: TextModel) -> int:
+    """Most tokens a single attachment block keeps before it's trimmed."""
+    return max(MIN_BLOCK_TOKENS, int(prompt_budget(model) * MAX_BLOCK_SHARE))
+
+
+def pack_context(
+    system: ChatMessage, history: list[ChatMessage], model: TextModel
+) -> PackedContext:
+    """
+    Fit `system` and as much of `history` as possible into `model`'s prompt budget.
+
+    Oversized attachment blocks are trimmed to their head and tail first. History is
+    then filled newest-first, and the oldest messages that don't fit are dropped. The
+    latest message is always kept, trimming it harder if that's what it takes.
+    """
+    budget = prompt_budget(model)
+    max_block_tokens = block_budget(model)
+    used = count_tokens(system.content) + MESSAGE_OVERHEAD_TOKENS
+    truncated: list[str] = []
+    packed: list[ChatMessage] = []
+    dropped = 0
+
+    for i, msg in enumerate(reversed(history)):
+        content = _trim_blocks(msg.content, max_block_tokens, truncated)
+        tokens = count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        if used + tokens > budget:
+            if packed:
+                dropped = len(history) - i
+                break
+            # Squeeze the latest message into whatever room is left
+            available = max(MIN_BLOCK_TOKENS, budget - used - MESSAGE_OVERHEAD_TOKENS)
+            content = _trim_blocks(content, available // 2, truncated)
+            content = trim_middle(content, available)
+            tokens = count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        packed.append(ChatMessage(content, msg.role, msg.name, dict(msg.meta)))
+        used += tokens
+
+    packed.reverse()
+    # Dropping turns can leave the history starting on an assistant message
+    if packed and not packed[0].is_from(ChatRole.USER):
+        packed.insert(0, ChatMessage.from_user("..."))
+        used += count_tokens("...") + MESSAGE_OVERHEAD_TOKENS
+
+    if dropped or truncated:
+        logger.info(
+            f"Packed context for {model.value} into {used}/{budget} tokens: "
+            f"dropped {dropped} older messages, truncated {len(truncated)} attachments "
+            f"{truncated}."
+        )
+    return PackedContext([system] + packed, used, budget, dropped, truncated)
@@ -0,0 +1,133 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable
+
+import freshness
+import s3_cache
+from context_packer import prompt_budget, trim_middle
+from lite_llms import SMALL_MODELS, TextModel
+from retrieval import MIN_CHARS, get_index
+
+logger = logging.getLogger(__name__)
+CACHE_NAMESPACE = "attachment_digests"
+s3_cache.set_max_size(CACHE_NAMESPACE, 1000)
+# Digests are written by the small model of the provider the session uses. Setting
+# DIGEST_MODEL to a model name sends every digest to that model instead.
+DIGEST_MODEL = (
+    TextModel(os.environ["DIGEST_MODEL"]) if os.environ.get("DIGEST_MODEL") else None
+)
+DIGEST_MAX_TOKENS = 1200
+DIGEST_WORKERS = 2
+# How long a turn may keep its invocation alive for digests still being written,
+# after replying, within the time the invocation has left. Kept short, since the
+# invocation is billed while it waits; unfinished ones are retried by the next
+# turn that needs them.
+DIGEST_WAIT_S = float(os.environ.get("DIGEST_WAIT_S", 5))
+INSTRUCTIONS_TOKENS = 256
+DIGEST_PROMPT = (
+    "Below is a document a user shared in a chat, split into numbered sections. "
+    "Write a digest of it, so that questions about the document can be answered "
+    "without the full text at hand. Give:\n"
+    "1. Summary: what the document is, its main points, and the key facts, figures, "
+    "names and dates, in at most 300 words.\n"
+    "2. Outline: consecutive sections grouped by topic, one line per group, like "
+    "'Sections 3-7: <what they cover>'.\n"
+    "Reply with the digest only."
+)
+
+
+def digest_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def digest_model(model: TextModel) -> TextModel:
+    """The model that digests documents shared with `model`."""
+    return DIGEST_MODEL or SMALL_MODELS.get(model, model)
+
+
+class Digester:
+    """
+    Writes digests of large attachments on background threads, and caches them by
+    the hash of the attachment text.
+
+    :param complete: Called with `model`, `messages` and `max_tokens`, and returns
+        the text of the reply.
+    """
+
+    def __init__(self, complete: Callable[..., str], workers: int = DIGEST_WORKERS):
+        self.complete = complete
+        self.workers = workers
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, text: str, model: TextModel) -> str | None:
+        """
+        The digest of `text` if there is one yet. If not, start writing it with the
+        `digest_model` of `model`, the model of the session it was shared in.
+        """
+        if len(text) < MIN_CHARS:
+            return None
+        key = digest_key(text)
+        digest = s3_cache.get_cache(CACHE_NAMESPACE, key)
+        if digest is None:
+            self.schedule(key, text, digest_model(model))
+        return digest
+
+    def schedule(self, key: str, text: str, model: TextModel) -> None:
+        with self._lock:
+            if key in self._pending:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="digest"
+                )
+            self._pending[key] = self._executor.submit(self._run, key, text, model)
+
+    def _run(self, key: str, text: str, model: TextModel) -> None:
+        try:
+            # Caches the digest, and backs off from documents that keep failing
+            freshness.get_or_refresh(
+                CACHE_NAMESPACE, key, lambda: self.write(text, model)
+            )
+        except freshness.CachedFailure:
+            pass
+        except Exception as e:
+            logger.error(f"Digest of a {len(text)} character attachment failed: {e}")
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def write(self, text: str, model: TextModel) -> str | None:
+        spans = get_index(text).spans
+        sections = "\n\n".join(
+            f"[Section {i + 1}/{len(spans)}]\n{text[start:end].strip()}"
+            for i, (start, end) in enumerate(spans)
+        )
+        sections = trim_middle(sections, prompt_budget(model) - INSTRUCTIONS_TOKENS)
+        digest = self.complete(
+            model=model,
+            messages=[
+                {"role": "system", "content": DIGEST_PROMPT},
+                {"role": "user", "content": sections},
+            ],
+            max_tokens=DIGEST_MAX_TOKENS,
+        )
+        logger.info(
+            f"{model.value} wrote a {len(digest)} character digest of {len(text)} "
+            "characters."
+        )
+        return digest.strip() or None
+
+    def wait(self, timeout: float = DIGEST_WAIT_S) -> None:
+        """Wait up to `timeout` seconds for the digests being written."""
+        with self._lock:
+            pending = list(self._pending.values())
+        if not pending:
+            return
+        _, not_done = wait(pending, timeout=timeout)
+        if not_done:
+            logger.warning(f"Left {len(not_done)} digests unfinished.")
@@ -0,0 +1,121 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable
+
+from aws_lambda_powertools import Logger
+
+import telemetry
+from messages import ChatMessage
+
+logger = Logger()
+
+MAX_WORKERS = int(os.environ.get("ENRICHMENT_MAX_WORKERS", 8))
+# How long a single fetch may run once started, and how long a whole turn may
+# wait on enrichment before replying with whatever is ready.
+JOB_TIMEOUT_S = float(os.environ.get("ENRICHMENT_JOB_TIMEOUT_S", 20))
+TURN_DEADLINE_S = float(os.environ.get("ENRICHMENT_TURN_DEADLINE_S", 40))
+
+
+@dataclass
+class EnrichmentJob:
+    """
+    A deferred fetch (link, transcript, file) whose result is spliced into history.
+
+    :param name: Human-readable name of the resource, used in logs.
+    :param run: Produces the message to splice in, or None to add nothing.
+    :param fallback: Message used instead when the job fails or runs out of time.
+    :param failed: Set once the job has resolved to its fallback.
+    :param kind: What is fetched, like "link" or "file", used as a metric dimension.
+    """
+
+    name: str
+    run: Callable[[], ChatMessage | None]
+    fallback: ChatMessage | None
+    failed: bool = False
+    kind: str = "other"
+
+
+def run_jobs(
+    jobs: list[EnrichmentJob],
+    max_workers: int = MAX_WORKERS,
+    job_timeout: float = JOB_TIMEOUT_S,
+    turn_deadline: float = TURN_DEADLINE_S,
+) -> list[ChatMessage | None]:
+    """
+    Run `jobs` concurrently on a bounded pool and return their results in order.
+
+    Jobs that raise, run longer than `job_timeout`, or are still unfinished when
+    `turn_deadline` expires resolve to their fallback. Stragglers are abandoned
+    rather than awaited, so a slow link never blocks the reply.
+    """
+    results: list[ChatMessage | None] = [None] * len(jobs)
+    if not jobs:
+        return results
+
+    started: dict[int, float] = {}
+
+    def run(i: int) -> ChatMessage | None:
+        started[i] = time.monotonic()
+        with telemetry.span("EnrichmentLatency", kind=jobs[i].kind):
+            return jobs[i].run()
+
+    executor = ThreadPoolExecutor(
+        max_workers=min(max_workers, len(jobs)), thread_name_prefix="enrichment"
+    )
+    futures: dict[Future, int] = {executor.submit(run, i): i for i in range(len(jobs))}
+    pending = set(futures)
+    deadline = time.monotonic() + turn_deadline
+    try:
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            # Wake up for whichever comes first: a completion, a job's own timeout,
+            # or the turn deadline
+            wake_at = min(
+                [
+                    started[futures[f]] + job_timeout
+                    for f in pending
+                    if futures[f] in started
+                ],
+                default=deadline,
+            )
+            done, pending = wait(
+                pending,
+                timeout=max(0.0, min(wake_at, deadline) - now),
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    logger.error(f"Enrichment of [{jobs[i].name}] failed: {str(e)}")
+                    telemetry.count(
+                        "EnrichmentFailures", kind=jobs[i].kind, reason="error"
+                    )
+                    jobs[i].failed = True
+                    results[i] = jobs[i].fallback
+
+            now = time.monotonic()
+            for future in list(pending):
+                i = futures[future]
+                if i in started and now - started[i] >= job_timeout:
+                    logger.warning(f"Enrichment of [{jobs[i].name}] timed out.")
+                    telemetry.count(
+                        "EnrichmentFailures", kind=jobs[i].kind, reason="timeout"
+                    )
+                    pending.discard(future)
+                    jobs[i].failed = True
+                    results[i] = jobs[i].fallback
+    finally:
+        for future in pending:
+            i = futures[future]
+            logger.warning(f"Enrichment of [{jobs[i].name}] missed the turn deadline.")
+            telemetry.count("EnrichmentFailures", kind=jobs[i].kind, reason="deadline")
+            jobs[i].failed = True
+            results[i] = jobs[i].fallback
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
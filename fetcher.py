@@ -0,0 +1,169 @@
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator
+from urllib.parse import urlsplit
+
+import requests  # type: ignore
+from requests.adapters import HTTPAdapter  # type: ignore
+
+from local_cache import MemoryLRU
+
+logger = logging.getLogger(__name__)
+MAX_DOWNLOAD_BYTES = int(os.environ.get("FETCH_MAX_BYTES", 50 * 1024 * 1024))
+DOWNLOAD_DEADLINE_S = float(os.environ.get("FETCH_DEADLINE_S", 20))
+CONNECT_TIMEOUT_S = 5
+# Bodies up to this size stay in memory; larger ones roll over to a file in /tmp
+SPOOL_MEMORY_BYTES = 1024 * 1024
+CHUNK_BYTES = 64 * 1024
+# Concurrent requests allowed to any one host, so a burst of links to the same
+# site doesn't open a connection each
+MAX_PER_HOST = int(os.environ.get("FETCH_MAX_PER_HOST", 4))
+POOL_HOSTS = 32
+USER_AGENT = "Mozilla/5.0 (compatible; SushiBot/1.0)"
+
+# Bodies with a validator are kept for conditional re-fetches, bounded by total size
+CACHE_MAX_BYTES = int(os.environ.get("FETCH_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+CACHE_MAX_ENTRY_BYTES = 4 * 1024 * 1024
+response_cache = MemoryLRU(CACHE_MAX_BYTES)
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+_host_slots: dict[str, threading.BoundedSemaphore] = {}
+
+
+class DownloadError(Exception):
+    pass
+
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    etag: str | None
+    last_modified: str | None
+
+
+def http_session() -> requests.Session:
+    """
+    The process-wide `requests.Session`. Its pooled connections outlive the
+    invocation, so warm invocations skip the TCP and TLS handshakes.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=POOL_HOSTS, pool_maxsize=MAX_PER_HOST
+            )
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session.headers["User-Agent"] = USER_AGENT
+        return _session
+
+
+@contextmanager
+def _host_slot(url: str, timeout: float) -> Iterator[None]:
+    host = urlsplit(url).netloc.lower()
+    with _session_lock:
+        slots = _host_slots.setdefault(host, threading.BoundedSemaphore(MAX_PER_HOST))
+    if not slots.acquire(timeout=max(timeout, 0)):
+        raise requests.exceptions.Timeout(f"No free connection to [{host}].")
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+def head(url: str, timeout: float, **kwargs) -> requests.Response:
+    with _host_slot(url, timeout):
+        return http_session().head(url, timeout=timeout, **kwargs)
+
+
+def download(
+    url: str,
+    headers: dict[str, str] | None = None,
+    max_bytes: int = MAX_DOWNLOAD_BYTES,
+    deadline_s: float = DOWNLOAD_DEADLINE_S,
+) -> BinaryIO:
+    """
+    Stream `url` into a temporary file and return it, rewound to the start.
+
+    The body is read in chunks and never held whole as `bytes`. Anything past
+    `SPOOL_MEMORY_BYTES` is spooled to disk under /tmp, and the file is deleted once
+    closed. Small bodies that come with an `ETag` or `Last-Modified` are also kept in
+    `response_cache`, and are revalidated rather than downloaded again.
+
+    Raises `DownloadError` if the server reports a failure, the body grows past
+    `max_bytes`, or the whole download takes longer than `deadline_s`.
+    """
+    deadline = time.monotonic() + deadline_s
+    request_headers = dict(headers or {})
+    cached: CachedResponse | None = response_cache.get(url)
+    if cached is not None:
+        if cached.etag:
+            request_headers["If-None-Match"] = cached.etag
+        if cached.last_modified:
+            request_headers["If-Modified-Since"] = cached.last_modified
+
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+    try:
+        with _host_slot(url, deadline_s), http_session().get(
+            url,
+            headers=request_headers,
+            stream=True,
+            timeout=(CONNECT_TIMEOUT_S, deadline_s),
+        ) as response:
+            if response.status_code == 304 and cached is not None:
+                logger.info(f"Not modified since cached: [{url}].")
+                spool.close()
+                return io.BytesIO(cached.body)
+            if response.status_code != 200:
+                raise DownloadError(
+                    f"Error downloading file [{url}]. HTTP request status: {response.status_code}"
+                )
+            length = int(response.headers.get("Content-Length") or 0)
+            if length > max_bytes:
+                raise DownloadError(
+                    f"File [{url}] is {length} bytes, over the {max_bytes} byte limit."
+                )
+            size = 0
+            for chunk in response.iter_content(CHUNK_BYTES):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise DownloadError(
+                        f"File [{url}] is over the {max_bytes} byte limit."
+                    )
+                if time.monotonic() > deadline:
+                    raise DownloadError(
+                        f"Download of [{url}] took over {deadline_s:.0f} seconds."
+                    )
+                spool.write(chunk)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+        logger.info(f"Downloaded {size} bytes from [{url}].")
+
+        spool.seek(0)
+        if (etag or last_modified) and size <= CACHE_MAX_ENTRY_BYTES:
+            entry = CachedResponse(spool.read(), etag, last_modified)
+            response_cache.put(url, entry, size)
+            spool.seek(0)
+        else:
+            response_cache.delete(url)
+        return spool  # type: ignore
+    except requests.RequestException as e:
+        spool.close()
+        raise DownloadError(f"Error downloading file [{url}]: {str(e)}") from e
+    except BaseException:
+        spool.close()
+        raise
+
+
+def fetch_bytes(url: str, headers: dict[str, str] | None = None, **kwargs) -> bytes:
+    """Download `url` whole. Only for bodies already capped small by `max_bytes`."""
+    with download(url, headers, **kwargs) as body:
+        return body.read()
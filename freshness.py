@@ -0,0 +1,160 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+
+import s3_cache
+
+logger = logging.getLogger(__name__)
+REFRESH_WORKERS = 2
+
+# Failed fetches are remembered, so a dead link isn't retried on every turn. The
+# wait before the next attempt doubles with each consecutive failure.
+FAILURE_NAMESPACE = "fetch_failures"
+s3_cache.set_max_size(FAILURE_NAMESPACE, 2000)
+s3_cache.set_remote_only(FAILURE_NAMESPACE)
+FAILURE_TTL_BASE_S = 5 * 60
+FAILURE_TTL_MAX_S = 24 * 60 * 60
+# Recorded when `fetch` returns None: there was nothing to fetch, rather than an error
+EMPTY = "empty"
+
+
+@dataclass(frozen=True)
+class FreshnessPolicy:
+    """
+    :param ttl_s: Entries younger than this are served as they are.
+    :param stale_s: For this long past `ttl_s`, entries are still served, but
+        refreshed in the background. Older entries count as misses.
+    """
+
+    ttl_s: float
+    stale_s: float
+
+
+POLICIES: dict[str, FreshnessPolicy] = {}
+_refreshing: set[tuple[str, str]] = set()
+_refresh_lock = threading.Lock()
+_executor: ThreadPoolExecutor | None = None
+
+
+class CachedFailure(Exception):
+    """A recent attempt at this fetch failed, and it's too soon to try again."""
+
+
+def set_policy(namespace: str, ttl_s: float, stale_s: float) -> None:
+    POLICIES[namespace] = FreshnessPolicy(ttl_s, stale_s)
+
+
+def _failure_key(namespace: str, key: str) -> str:
+    return f"{namespace}:{key}"
+
+
+def _get_failure(namespace: str, key: str) -> dict | None:
+    data = s3_cache.get_cache(FAILURE_NAMESPACE, _failure_key(namespace, key))
+    if not data:
+        return None
+    try:
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+def _record_failure(
+    namespace: str, key: str, reason: str, previous: dict | None
+) -> None:
+    failures = (previous or {}).get("failures", 0) + 1
+    ttl = min(FAILURE_TTL_BASE_S * 2 ** (failures - 1), FAILURE_TTL_MAX_S)
+    logger.info(f"Fetch of [{key}] failed {failures} times ({reason}), next in {ttl}s.")
+    record = {
+        "reason": reason[:200],
+        "failures": failures,
+        "retry_at": time.time() + ttl,
+    }
+    s3_cache.set_cache(
+        FAILURE_NAMESPACE, _failure_key(namespace, key), json.dumps(record)
+    )
+
+
+def _refresh(namespace: str, key: str, fetch: Callable[[], str | None]) -> None:
+    try:
+        value = fetch()
+        if value is not None:
+            s3_cache.set_cache(namespace, key, value)
+            logger.info(f"Refreshed stale [{namespace}] entry for [{key}].")
+    except Exception as e:
+        logger.error(f"Background refresh of [{key}] failed, keeping it: {str(e)}")
+    finally:
+        with _refresh_lock:
+            _refreshing.discard((namespace, key))
+
+
+def _schedule_refresh(
+    namespace: str, key: str, fetch: Callable[[], str | None]
+) -> None:
+    """Refresh an entry in the background, unless a refresh of it is already running."""
+    global _executor
+    with _refresh_lock:
+        if (namespace, key) in _refreshing:
+            return
+        _refreshing.add((namespace, key))
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=REFRESH_WORKERS, thread_name_prefix="refresh"
+            )
+    _executor.submit(_refresh, namespace, key, fetch)
+
+
+def get_or_refresh(
+    namespace: str, key: str, fetch: Callable[[], str | None]
+) -> str | None:
+    """
+    Read `key` from the cache, calling `fetch` to fill it according to the
+    namespace's `FreshnessPolicy`.
+
+    Fresh and stale entries return straight away, and stale ones get a background
+    refresh. Only a miss, or an entry past its stale window, waits on `fetch`, and
+    only if the last failure of that fetch has timed out.
+
+    A failed fetch is recorded with its reason, and falls back on the expired entry if
+    there is one. Otherwise an error is raised again, or as `CachedFailure` while the
+    failure is recent, and an empty result returns None. Namespaces without a policy
+    never expire.
+    """
+    entry = s3_cache.get_entry(namespace, key)
+    policy = POLICIES.get(namespace)
+    if entry is not None:
+        value, stored_at = entry
+        if policy is None:
+            return value
+        age = time.time() - stored_at
+        if age <= policy.ttl_s:
+            return value
+        if age <= policy.ttl_s + policy.stale_s:
+            _schedule_refresh(namespace, key, fetch)
+            return value
+
+    failure = _get_failure(namespace, key)
+    if failure and failure["retry_at"] > time.time():
+        if entry is not None:
+            return entry[0]
+        if failure["reason"] == EMPTY:
+            return None
+        raise CachedFailure(failure["reason"])
+
+    try:
+        fetched = fetch()
+    except Exception as e:
+        _record_failure(namespace, key, f"{type(e).__name__}: {str(e)}", failure)
+        if entry is not None:
+            return entry[0]
+        raise
+    if fetched is None:
+        _record_failure(namespace, key, EMPTY, failure)
+        return entry[0] if entry else None
+    s3_cache.set_cache(namespace, key, fetched)
+    if failure:
+        s3_cache.delete_cache(FAILURE_NAMESPACE, _failure_key(namespace, key))
+    return fetched
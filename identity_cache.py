@@ -0,0 +1,60 @@
+import os
+from typing import TYPE_CHECKING, Any
+
+from aws_lambda_powertools import Logger
+from slack_sdk import WebClient
+
+from local_cache import TTLCache
+
+if TYPE_CHECKING:
+    from slack_sdk.web.async_client import AsyncWebClient
+
+logger = Logger()
+
+# Module-level, so lookups survive across warm Lambda invocations
+IDENTITY_TTL_S = float(os.environ.get("IDENTITY_CACHE_TTL_S", 6 * 60 * 60))
+MAX_ENTRIES = 1000
+bot_user_ids = TTLCache(MAX_ENTRIES, IDENTITY_TTL_S)
+user_names = TTLCache(MAX_ENTRIES, IDENTITY_TTL_S)
+
+
+def remember_authorizations(body: dict[str, Any]) -> None:
+    """Record the bot's user id from the authorizations Slack sends with each event."""
+    for authorization in body.get("authorizations") or []:
+        if authorization.get("is_bot") and authorization.get("user_id"):
+            bot_user_ids.put(
+                authorization.get("team_id") or "", authorization["user_id"]
+            )
+
+
+def get_bot_user_id(client: WebClient, team_id: str | None = None) -> str:
+    key = team_id or ""
+    bot_user_id = bot_user_ids.get(key)
+    if bot_user_id is None:
+        bot_user_id = client.auth_test()["user_id"]
+        bot_user_ids.put(key, bot_user_id)
+    return bot_user_id
+
+
+def get_user_real_name(client: WebClient, user_id: str) -> str:
+    real_name = user_names.get(user_id)
+    if real_name is None:
+        real_name = client.users_info(user=user_id)["user"]["real_name"]
+        user_names.put(user_id, real_name)
+    return real_name
+
+
+async def aget_user_real_name(client: "AsyncWebClient", user_id: str) -> str:
+    real_name = user_names.get(user_id)
+    if real_name is None:
+        real_name = (await client.users_info(user=user_id))["user"]["real_name"]
+        user_names.put(user_id, real_name)
+    return real_name
+
+
+def handle_user_change(user: dict[str, Any]) -> None:
+    """Refresh a cached profile from a `user_change` event."""
+    logger.info(f"Profile of [{user.get('id')}] changed.")
+    user_names.delete(user.get("id", ""))
+    if user.get("id") and user.get("real_name"):
+        user_names.put(user["id"], user["real_name"])
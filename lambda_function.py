@@ -1,30 +1,50 @@
+import asyncio
+import base64
+import json
 import logging
 import os
+import time
 import traceback
+from typing import Any
 
-from aws_lambda_powertools import Logger, Metrics
+from aws_lambda_powertools import Logger
 from aws_lambda_powertools.event_handler import APIGatewayRestResolver
 from aws_lambda_powertools.logging import correlation_paths
 from slack_bolt import App
 from slack_bolt.adapter.aws_lambda import SlackRequestHandler
 from slack_sdk import WebClient
 
-from session import ERROR_HEADER, ChatSession
+import identity_cache
+import s3_cache
+import telemetry
+import transcript_store
+from digests import DIGEST_WAIT_S
+from session import ERROR_HEADER, ChatSession, digester
+from telemetry import metrics
 
 # Configure logger
 app = APIGatewayRestResolver()
 logger = Logger()
-metrics = Metrics(namespace="Powertools")
 
 # Initializes your app with your bot token and socket mode handler
 slack_app = App(
     token=os.environ.get("SLACK_BOT_TOKEN"),
     signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
     process_before_response=True,
+    # Skip the auth.test call Bolt makes at construction; the first request
+    # authorizes instead, so a cold start doesn't wait on Slack before handling it
+    token_verification_enabled=False,
 )
 
 # Also initialize the WebClient with bot token
 client = WebClient(token=os.environ.get("SLACK_BOT_TOKEN"))
+# Overlap the Slack calls, enrichment and completion of a turn on an event loop.
+# Set to 0 to handle messages one step after another, as before.
+ASYNC_PIPELINE = os.environ.get("ASYNC_PIPELINE", "1") != "0"
+# When the running Lambda invocation times out, on the monotonic clock, and how
+# much of that time to leave for logs and metrics to flush
+invocation_deadline: float | None = None
+DEADLINE_MARGIN_S = 2.0
 
 
 def just_ack(ack):
@@ -43,6 +63,11 @@ def handle_mention(body, say, logger):
     )
 
 
+def handle_user_change(ack, body):
+    ack()
+    identity_cache.handle_user_change(body["event"].get("user") or {})
+
+
 def handle_message(body, say, logger):
     logger.debug(body)
     event = body["event"]
@@ -50,22 +75,114 @@ def handle_message(body, say, logger):
     if channel_type != "im":
         return
     channel_id = event.get("channel") or ""
+    subtype = event.get("subtype")
+    if subtype in ("message_changed", "message_deleted"):
+        # Only user edits and deletions invalidate history here, not bot edits
+        # while streaming or link unfurls
+        if transcript_store.alters_history(event):
+            transcript_store.invalidate(channel_id)
+        return
     user_id = event["user"]
     text = event.get("text") or ""
 
     # Check if the message was sent by the user and not this app
-    bot_user_id = slack_app.client.auth_test()["user_id"]
+    identity_cache.remember_authorizations(body)
+    bot_user_id = identity_cache.get_bot_user_id(slack_app.client, body.get("team_id"))
     if user_id == bot_user_id:
         logger.info("This message was sent by the bot itself. Ignoring.")
         return
 
     try:
-        user_session = ChatSession(user_id, channel_id, client)
-        user_session.process_direct_message(text, say, logger)
+        with telemetry.span("TurnLatency"):
+            if ASYNC_PIPELINE:
+                asyncio.run(
+                    process_message_async(user_id, channel_id, text, say, logger, event)
+                )
+            else:
+                user_session = ChatSession(user_id, channel_id, client)
+                user_session.process_direct_message(
+                    text, say, logger, ts=event.get("ts")
+                )
     except Exception as e:
+        telemetry.count("TurnErrors")
         say(ERROR_HEADER + "\n```\n" + str(e) + "\n```\n")
         traceback.print_exc()
-
+    else:
+        # The reply is out; finish digests of newly shared documents before this
+        # invocation ends and the environment is frozen, if there's time left.
+        # A failed turn doesn't wait: its digests are retried by the next turn.
+        wait_s = DIGEST_WAIT_S
+        if invocation_deadline is not None:
+            time_left = invocation_deadline - time.monotonic() - DEADLINE_MARGIN_S
+            wait_s = max(min(wait_s, time_left), 0)
+        digester.wait(wait_s)
+    finally:
+        s3_cache.flush_indexes()
+
+
+async def process_message_async(user_id, channel_id, text, say, logger, event):
+    # Loaded here rather than at import, since acks never need them
+    import aiohttp
+    from slack_sdk.web.async_client import AsyncWebClient
+
+    # One connection pool for every Slack call of the turn
+    async with aiohttp.ClientSession() as http:
+        async_client = AsyncWebClient(
+            token=os.environ.get("SLACK_BOT_TOKEN"), session=http
+        )
+        user_session = ChatSession(user_id, channel_id, client, lookup=False)
+        await user_session.process_direct_message_async(
+            text, say, logger, async_client, ts=event.get("ts")
+        )
+
+
+def ignored_reason(body: dict[str, Any]) -> str | None:
+    """
+    Say why `handle_message` would drop this event, without calling Slack.
+
+    Mirrors its early returns, so these events can be acked before Bolt dispatches
+    them and schedules a lazy invocation that would do nothing. The request isn't
+    verified yet, so this only reads the identity cache; `handle_message` records
+    the authorizations once Bolt has checked the signature.
+    """
+    if body.get("type") != "event_callback":
+        return None
+    event = body.get("event") or {}
+    if event.get("type") != "message":
+        return None
+    if event.get("channel_type") != "im":
+        return "not a direct message"
+    if event.get("subtype") in ("message_changed", "message_deleted"):
+        return (
+            None
+            if transcript_store.alters_history(event)
+            else "bot edit or link unfurl"
+        )
+    bot_user_id = identity_cache.bot_user_ids.get(body.get("team_id") or "")
+    if bot_user_id and event.get("user") == bot_user_id:
+        return "sent by the bot itself"
+    return None
+
+
+def _parse_body(event: dict[str, Any]) -> dict[str, Any] | None:
+    """Decode a JSON request body from API Gateway. Anything else is left to Bolt."""
+    body = event.get("body") or ""
+    try:
+        if event.get("isBase64Encoded"):
+            body = base64.b64decode(body).decode("utf-8")
+        if not body.lstrip().startswith("{"):
+            return None
+        parsed = json.loads(body)
+        return parsed if isinstance(parsed, dict) else None
+    except ValueError:
+        return None
+
+
+# Register listeners once per execution environment, not once per invocation
+slack_app.event("app_mention")(ack=just_ack, lazy=[handle_mention])
+slack_app.event("message")(ack=just_ack, lazy=[handle_message])
+slack_app.event("user_change")(handle_user_change)
+slack_handler = SlackRequestHandler(app=slack_app)
 
 SlackRequestHandler.clear_all_log_handlers()
 logging.basicConfig(
@@ -77,14 +194,31 @@ logging.basicConfig(
 @logger.inject_lambda_context(
     log_event=True, correlation_id_path=correlation_paths.API_GATEWAY_REST
 )
+@metrics.log_metrics
 def handler(event, context):
+    global invocation_deadline
+    invocation_deadline = (
+        time.monotonic() + context.get_remaining_time_in_millis() / 1000
+    )
+    try:
+        with telemetry.span("HandlerLatency"):
+            return dispatch(event, context)
+    finally:
+        # Every invocation has at least HandlerLatency, so log_metrics never
+        # finds the shared metrics empty
+        telemetry.flush()
+
+
+def dispatch(event, context):
     headers = event.get("headers", {})
     if "X-Slack-Retry-Num" in headers or "x-slack-retry-num" in headers:
         logger.debug("Ignoring Slack retry")
         return 200
-    slack_app.event("app_mention")(ack=just_ack, lazy=[handle_mention])
-    slack_app.event("message")(ack=just_ack, lazy=[handle_message])
-    slack_handler = SlackRequestHandler(app=slack_app)
+    body = _parse_body(event)
+    reason = ignored_reason(body) if body else None
+    if reason:
+        logger.debug(f"Acking without dispatch: {reason}")
+        return {"statusCode": 200, "body": ""}
     return slack_handler.handle(event, context)  # type:ignore
 
 
@@ -18,3 +18,59 @@ class TextModel(Enum):
     LLAMA3_70B = "fireworks_ai/llama-v3-70b-instruct"
     LLAMA31_405B = "fireworks_ai/llama-v3p1-405b-instruct"
     LLAMA31_8B = "fireworks_ai/llama-v3p1-8b-instruct"
+
+
+# Context window and the part of it kept free for the response, in tokens
+CONTEXT_LIMITS: dict[TextModel, tuple[int, int]] = {
+    TextModel.GPT_35: (16_385, 4_096),
+    TextModel.GPT_4O: (128_000, 4_096),
+    TextModel.GPT_4O_MINI: (128_000, 16_384),
+    TextModel.GPT_4_TURBO: (128_000, 4_096),
+    TextModel.O1_PREVIEW: (128_000, 32_768),
+    TextModel.O1_MINI: (128_000, 65_536),
+    TextModel.CLAUDE_3_OPUS: (200_000, 4_096),
+    TextModel.CLAUDE_35_SONNET: (200_000, 8_192),
+    TextModel.CLAUDE_3_HAIKU: (200_000, 4_096),
+    TextModel.GEMINI_15_PRO: (2_097_152, 8_192),
+    TextModel.GEMINI_15_FLASH: (1_048_576, 8_192),
+    TextModel.LLAMA3_70B: (8_192, 2_048),
+    TextModel.LLAMA31_405B: (131_072, 4_096),
+    TextModel.LLAMA31_8B: (131_072, 4_096),
+}
+
+# A comparable model from another provider, for when a model is slow or failing.
+# Some have a smaller prompt budget than the model they stand in for (like
+# LLAMA31_8B -> GPT_4O_MINI); the router skips a fallback that can't fit the prompt.
+FALLBACK_MODELS: dict[TextModel, TextModel] = {
+    TextModel.GPT_35: TextModel.CLAUDE_3_HAIKU,
+    TextModel.GPT_4O: TextModel.CLAUDE_35_SONNET,
+    TextModel.GPT_4O_MINI: TextModel.CLAUDE_3_HAIKU,
+    TextModel.GPT_4_TURBO: TextModel.CLAUDE_35_SONNET,
+    TextModel.CLAUDE_3_OPUS: TextModel.GPT_4O,
+    TextModel.CLAUDE_35_SONNET: TextModel.GPT_4O,
+    TextModel.CLAUDE_3_HAIKU: TextModel.GPT_4O_MINI,
+    TextModel.GEMINI_15_PRO: TextModel.CLAUDE_35_SONNET,
+    TextModel.GEMINI_15_FLASH: TextModel.GPT_4O_MINI,
+    TextModel.LLAMA3_70B: TextModel.GPT_4O_MINI,
+    TextModel.LLAMA31_405B: TextModel.GPT_4O,
+    TextModel.LLAMA31_8B: TextModel.GPT_4O_MINI,
+}
+
+# The small model from the same provider, for background work on a user's behalf,
+# like digests, so it never sends their documents to a provider they didn't pick
+SMALL_MODELS: dict[TextModel, TextModel] = {
+    TextModel.GPT_35: TextModel.GPT_4O_MINI,
+    TextModel.GPT_4O: TextModel.GPT_4O_MINI,
+    TextModel.GPT_4O_MINI: TextModel.GPT_4O_MINI,
+    TextModel.GPT_4_TURBO: TextModel.GPT_4O_MINI,
+    TextModel.O1_PREVIEW: TextModel.GPT_4O_MINI,
+    TextModel.O1_MINI: TextModel.GPT_4O_MINI,
+    TextModel.CLAUDE_3_OPUS: TextModel.CLAUDE_3_HAIKU,
+    TextModel.CLAUDE_35_SONNET: TextModel.CLAUDE_3_HAIKU,
+    TextModel.CLAUDE_3_HAIKU: TextModel.CLAUDE_3_HAIKU,
+    TextModel.GEMINI_15_PRO: TextModel.GEMINI_15_FLASH,
+    TextModel.GEMINI_15_FLASH: TextModel.GEMINI_15_FLASH,
+    TextModel.LLAMA3_70B: TextModel.LLAMA31_8B,
+    TextModel.LLAMA31_405B: TextModel.LLAMA31_8B,
+    TextModel.LLAMA31_8B: TextModel.LLAMA31_8B,
+}
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+from aws_lambda_powertools import Logger
+
+logger = Logger()
+
+
+class MemoryLRU:
+    """In-process LRU cache bounded by the total byte size of its values."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: OrderedDict[str, tuple[Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, value: Any, size: int) -> None:
+        if size > self.max_bytes:
+            # Never let a single entry flush the whole cache
+            self.delete(key)
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class DiskCache:
+    """
+    Size-capped file cache in a local directory.
+
+    Under Lambda, `/tmp` outlives a single invocation, so entries written here are
+    served to later warm invocations of the same execution environment. Files are
+    named by the hash of their key, and the least recently used ones (by mtime) are
+    evicted once the directory grows over `max_bytes`.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._sizes: OrderedDict[str, int] | None = None
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def _load(self) -> OrderedDict[str, int]:
+        # Pick up whatever a previous invocation left behind, oldest first
+        if self._sizes is None:
+            os.makedirs(self.root, exist_ok=True)
+            files = []
+            for entry in os.scandir(self.root):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.path, stat.st_size))
+            files.sort()
+            self._sizes = OrderedDict((path, size) for _, path, size in files)
+            self._total_bytes = sum(self._sizes.values())
+        return self._sizes
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.error(f"Error reading disk cache entry {path}: {str(e)}")
+            return None
+        with self._lock:
+            sizes = self._load()
+            if path in sizes:
+                sizes.move_to_end(path)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            self.delete(key)
+            return
+        path = self._path(key)
+        try:
+            with self._lock:
+                sizes = self._load()
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self._total_bytes += len(data) - sizes.pop(path, 0)
+                sizes[path] = len(data)
+                while self._total_bytes > self.max_bytes and sizes:
+                    evicted_path, evicted_size = sizes.popitem(last=False)
+                    self._total_bytes -= evicted_size
+                    try:
+                        os.remove(evicted_path)
+                    except FileNotFoundError:
+                        pass
+        except OSError as e:
+            logger.error(f"Error writing disk cache entry {path}: {str(e)}")
+
+    def delete(self, key: str) -> None:
+        path = self._path(key)
+        try:
+            with self._lock:
+                sizes = self._load()
+                self._total_bytes -= sizes.pop(path, 0)
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Error deleting disk cache entry {path}: {str(e)}")
+
+
+class TTLCache:
+    """Small in-process map whose entries expire after `ttl` seconds."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
@@ -0,0 +1,508 @@
+import asyncio
+import os
+import queue
+import statistics
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Iterator
+
+from aws_lambda_powertools import Logger
+
+import telemetry
+from context_packer import prompt_budget
+from lite_llms import FALLBACK_MODELS, TextModel
+
+logger = Logger()
+
+# Statistics are per execution environment. Samples older than STATS_MAX_AGE_S no
+# longer count, so a model routed around while failing gets tried again later.
+STATS_WINDOW = int(os.environ.get("MODEL_STATS_WINDOW", 50))
+STATS_MAX_AGE_S = float(os.environ.get("MODEL_STATS_MAX_AGE_S", 15 * 60))
+MIN_SAMPLES = 5
+# Models failing at least this often go after their fallback, not before it
+MAX_ERROR_RATE = 0.5
+# With MODEL_HEDGE=1, a streamed completion starts its fallback too once the first
+# token is this many times later than the model's median, within [HEDGE_MIN_S,
+# HEDGE_MAX_S]. Until there are enough samples, it waits HEDGE_MAX_S. Off by
+# default: a hedge sends the conversation, shared documents included, to another
+# provider, and pays for both completions.
+HEDGE_ENABLED = os.environ.get("MODEL_HEDGE", "0") != "0"
+HEDGE_MAX_S = float(os.environ.get("MODEL_HEDGE_AFTER_S", 8))
+HEDGE_MIN_S = 1.5
+HEDGE_TTFT_MULTIPLIER = 3
+# For output rates of providers that don't stream their usage
+CHARS_PER_TOKEN = 4
+
+
+@dataclass
+class Sample:
+    """
+    One request to a model.
+
+    :param ttft_s: Seconds until the first token, or the whole response when not
+        streamed. None if it never came.
+    :param tokens_per_s: Output rate after the first token, if streamed.
+    :param error: The request failed.
+    :param lost: The request was abandoned for a hedge that answered first.
+    """
+
+    at: float
+    ttft_s: float | None = None
+    tokens_per_s: float | None = None
+    error: bool = False
+    lost: bool = False
+
+
+class ModelStats:
+    """Rolling latency and error statistics of one model."""
+
+    def __init__(self, window: int = STATS_WINDOW, max_age_s: float = STATS_MAX_AGE_S):
+        self.samples: deque[Sample] = deque(maxlen=window)
+        self.max_age_s = max_age_s
+
+    def summary(self) -> dict[str, Any]:
+        cutoff = time.time() - self.max_age_s
+        samples = [s for s in self.samples if s.at >= cutoff]
+        settled = [s for s in samples if not s.lost]
+        errors = sum(s.error for s in settled)
+        ttfts = sorted(s.ttft_s for s in settled if s.ttft_s is not None)
+        rates = [s.tokens_per_s for s in settled if s.tokens_per_s]
+        return {
+            "requests": len(settled),
+            "errors": errors,
+            "error_rate": errors / len(settled) if settled else 0.0,
+            "hedged_out": len(samples) - len(settled),
+            "ttft_p50_s": statistics.median(ttfts) if ttfts else None,
+            "ttft_p90_s": ttfts[int(0.9 * (len(ttfts) - 1))] if ttfts else None,
+            "tokens_per_s": statistics.mean(rates) if rates else None,
+        }
+
+
+class _Attempt:
+    """One model's try at a routed request."""
+
+    def __init__(self, model: TextModel):
+        self.model = model
+        self.started = time.monotonic()
+        self.first_at: float | None = None
+        self.text: list[str] = []
+        self.usage: Any = None
+        self.failed = False
+        self.cancelled = False
+        self.task: asyncio.Task | None = None
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        if self.task is not None:
+            self.task.cancel()
+
+    def on_part(self, part: Any) -> bool:
+        """Note a streamed chunk. False for filler before the first token."""
+        text = _delta(part)
+        if self.first_at is None:
+            if not text:
+                return False
+            self.first_at = time.monotonic()
+        self.text.append(text)
+        self.usage = getattr(part, "usage", None) or self.usage
+        return True
+
+    def sample(self) -> Sample:
+        now = time.monotonic()
+        if self.failed:
+            return Sample(time.time(), error=True)
+        if self.first_at is None:
+            return Sample(time.time(), lost=self.cancelled)
+        sample = Sample(time.time(), ttft_s=self.first_at - self.started)
+        if self.text and now > self.first_at:
+            sample.tokens_per_s = self.output_tokens() / (now - self.first_at)
+        return sample
+
+    def output_tokens(self) -> float:
+        return getattr(self.usage, "completion_tokens", None) or (
+            sum(len(t) for t in self.text) / CHARS_PER_TOKEN
+        )
+
+
+def _delta(part: Any) -> str:
+    try:
+        return part.choices[0].delta.content or ""
+    except (AttributeError, IndexError):
+        return ""
+
+
+def portable(messages: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Undo prompt cache breakpoints, which only the provider they were set for takes."""
+    plain = []
+    for msg in messages:
+        content = msg["content"]
+        if isinstance(content, list) and all(b.get("type") == "text" for b in content):
+            msg = {**msg, "content": "".join(b["text"] for b in content)}
+        plain.append(msg)
+    return plain
+
+
+class RoutedStream:
+    """
+    Streamed chunks of whichever model answered a routed request.
+
+    :param model: The model requested, until one answers. Then the model answering.
+    """
+
+    def __init__(self, model: TextModel):
+        self.model = model
+        self._parts: Any = None
+
+    def __iter__(self) -> Iterator[Any]:
+        return self._parts
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        return self._parts
+
+
+class _Race:
+    """Attempts of one streamed request, and which of them answered first."""
+
+    def __init__(self, routed: RoutedStream, candidates: list[TextModel], hedge_after):
+        self.routed = routed
+        self.candidates = candidates
+        self.hedge_after: float | None = hedge_after
+        self.attempts: list[_Attempt] = []
+        self.winner: _Attempt | None = None
+
+    def pending(self) -> TextModel | None:
+        if len(self.attempts) < len(self.candidates):
+            return self.candidates[len(self.attempts)]
+        return None
+
+    def timeout(self) -> float | None:
+        """Seconds left before the next candidate starts as a hedge, if it will."""
+        if self.winner or self.hedge_after is None or self.pending() is None:
+            return None
+        return max(self.attempts[0].started + self.hedge_after - time.monotonic(), 0)
+
+    def on_timeout(self) -> TextModel:
+        hedge = self.pending()
+        logger.warning(
+            f"No token from {self.attempts[0].model.value} in {self.hedge_after:.1f}s, "
+            f"hedging with {hedge.value}."  # type: ignore
+        )
+        return hedge  # type: ignore
+
+    def on_event(self, kind: str, attempt: _Attempt, payload: Any) -> TextModel | None:
+        """
+        Settle the race on an event from `attempt`. Returns the model to start next,
+        if any, and raises once every candidate has failed.
+        """
+        if self.winner is not None:
+            return None
+        if kind == "error":
+            fallback = self.pending()
+            if fallback is not None:
+                logger.warning(
+                    f"{attempt.model.value} failed, falling back to {fallback.value}: "
+                    f"{str(payload)}"
+                )
+                return fallback
+            if all(a.failed for a in self.attempts):
+                raise payload
+            return None
+        self.winner = attempt
+        self.routed.model = attempt.model
+        for other in self.attempts:
+            if other is not attempt:
+                other.cancel()
+        if attempt is not self.attempts[0]:
+            logger.info(
+                f"{attempt.model.value} answered for {self.candidates[0].value}."
+            )
+        return None
+
+
+class ModelRouter:
+    """
+    Sends completions to a model, falling back to its `FALLBACK_MODELS` entry when
+    it fails before answering, and keeps rolling statistics of every model.
+
+    With hedging on, a streamed completion whose first token is late by the model's
+    own record also starts the fallback, and streams whichever answers first.
+
+    :param completion: Called like `litellm.completion`.
+    :param acompletion: Called like `litellm.acompletion`.
+    """
+
+    def __init__(
+        self,
+        completion: Callable[..., Any],
+        acompletion: Callable[..., Any] | None = None,
+        hedge: bool = HEDGE_ENABLED,
+        fallbacks: dict[TextModel, TextModel] = FALLBACK_MODELS,
+    ):
+        self.completion = completion
+        self.acompletion = acompletion
+        self.hedge = hedge
+        self.fallbacks = fallbacks
+        self._stats: dict[TextModel, ModelStats] = {}
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """Summary of each model's recent requests, by model name."""
+        with self._lock:
+            return {m.value: s.summary() for m, s in self._stats.items()}
+
+    def _summary(self, model: TextModel) -> dict[str, Any]:
+        with self._lock:
+            return self._stats.get(model, ModelStats()).summary()
+
+    def _record(self, attempt: _Attempt) -> None:
+        sample = attempt.sample()
+        with self._lock:
+            self._stats.setdefault(attempt.model, ModelStats()).samples.append(sample)
+        model = attempt.model.value
+        if sample.error:
+            telemetry.count("LlmErrors", model=model)
+        elif sample.lost:
+            telemetry.count("LlmHedgedOut", model=model)
+        elif sample.ttft_s is not None:
+            telemetry.record("LlmTimeToFirstToken", sample.ttft_s * 1000, model=model)
+            telemetry.count("LlmOutputTokens", attempt.output_tokens(), model=model)
+            prompt_tokens = getattr(attempt.usage, "prompt_tokens", None)
+            if prompt_tokens:
+                telemetry.count("LlmPromptTokens", prompt_tokens, model=model)
+
+    def candidates(self, model: TextModel, prompt_tokens: int = 0) -> list[TextModel]:
+        """`model` and its fallback, if the prompt fits it, healthier one first."""
+        fallback = self.fallbacks.get(model)
+        if fallback is None or prompt_tokens > prompt_budget(fallback):
+            return [model]
+        primary = self._summary(model)
+        if (
+            primary["requests"] >= MIN_SAMPLES
+            and primary["error_rate"] >= MAX_ERROR_RATE
+            and self._summary(fallback)["error_rate"] < primary["error_rate"]
+        ):
+            logger.warning(
+                f"{model.value} failed {primary['error_rate']:.0%} of recent requests, "
+                f"trying {fallback.value} first."
+            )
+            return [fallback, model]
+        return [model, fallback]
+
+    def hedge_after(self, model: TextModel) -> float | None:
+        """How long to wait for the first token of `model` before hedging."""
+        if not self.hedge:
+            return None
+        summary = self._summary(model)
+        if summary["requests"] < MIN_SAMPLES or summary["ttft_p50_s"] is None:
+            return HEDGE_MAX_S
+        budget = summary["ttft_p50_s"] * HEDGE_TTFT_MULTIPLIER
+        return min(max(budget, HEDGE_MIN_S), HEDGE_MAX_S)
+
+    def _race(self, model: TextModel, prompt_tokens: int) -> _Race:
+        candidates = self.candidates(model, prompt_tokens)
+        hedge_after = self.hedge_after(candidates[0]) if len(candidates) > 1 else None
+        return _Race(RoutedStream(model), candidates, hedge_after)
+
+    @staticmethod
+    def _messages_for(candidate: TextModel, model: TextModel, messages: list) -> list:
+        return messages if candidate is model else portable(messages)
+
+    def _once(self, candidate, model, messages, kwargs) -> tuple[TextModel, Any]:
+        attempt = _Attempt(candidate)
+        try:
+            response = self.completion(
+                model=candidate.value,
+                messages=self._messages_for(candidate, model, messages),
+                **kwargs,
+            )
+            attempt.first_at = time.monotonic()
+            attempt.usage = getattr(response, "usage", None)
+            return candidate, response
+        except Exception:
+            attempt.failed = True
+            raise
+        finally:
+            self._record(attempt)
+
+    async def _aonce(self, candidate, model, messages, kwargs) -> tuple[TextModel, Any]:
+        attempt = _Attempt(candidate)
+        try:
+            response = await self.acompletion(  # type: ignore
+                model=candidate.value,
+                messages=self._messages_for(candidate, model, messages),
+                **kwargs,
+            )
+            attempt.first_at = time.monotonic()
+            attempt.usage = getattr(response, "usage", None)
+            return candidate, response
+        except Exception:
+            attempt.failed = True
+            raise
+        finally:
+            self._record(attempt)
+
+    def complete(
+        self, model: TextModel, messages: list, prompt_tokens: int = 0, **kwargs
+    ) -> tuple[TextModel, Any]:
+        """A whole completion, and the model that gave it."""
+        *firsts, last = self.candidates(model, prompt_tokens)
+        for candidate in firsts:
+            try:
+                return self._once(candidate, model, messages, kwargs)
+            except Exception as e:
+                logger.warning(f"{candidate.value} failed, falling back: {str(e)}")
+        return self._once(last, model, messages, kwargs)
+
+    async def acomplete(
+        self, model: TextModel, messages: list, prompt_tokens: int = 0, **kwargs
+    ) -> tuple[TextModel, Any]:
+        """`complete`, awaiting `acompletion`."""
+        *firsts, last = self.candidates(model, prompt_tokens)
+        for candidate in firsts:
+            try:
+                return await self._aonce(candidate, model, messages, kwargs)
+            except Exception as e:
+                logger.warning(f"{candidate.value} failed, falling back: {str(e)}")
+        return await self._aonce(last, model, messages, kwargs)
+
+    def stream(
+        self, model: TextModel, messages: list, prompt_tokens: int = 0, **kwargs
+    ) -> RoutedStream:
+        """
+        Start a streamed completion and return its chunks. The request is sent
+        straight away, on a thread per attempt.
+        """
+        race = self._race(model, prompt_tokens)
+        events: queue.Queue = queue.Queue()
+
+        def pump(attempt: _Attempt, messages: list) -> None:
+            try:
+                response = self.completion(
+                    model=attempt.model.value, messages=messages, stream=True, **kwargs
+                )
+                for part in response:
+                    if attempt.cancelled:
+                        getattr(response, "close", lambda: None)()
+                        return
+                    if attempt.on_part(part):
+                        events.put(("chunk", attempt, part))
+                events.put(("done", attempt, None))
+            except Exception as e:
+                attempt.failed = True
+                events.put(("error", attempt, e))
+            finally:
+                self._record(attempt)
+
+        def start(candidate: TextModel) -> None:
+            attempt = _Attempt(candidate)
+            race.attempts.append(attempt)
+            threading.Thread(
+                target=pump,
+                args=(attempt, self._messages_for(candidate, model, messages)),
+                daemon=True,
+            ).start()
+
+        def parts() -> Iterator[Any]:
+            try:
+                while True:
+                    try:
+                        kind, attempt, payload = events.get(timeout=race.timeout())
+                    except queue.Empty:
+                        start(race.on_timeout())
+                        continue
+                    fallback = race.on_event(kind, attempt, payload)
+                    if fallback is not None:
+                        start(fallback)
+                    if attempt is not race.winner:
+                        continue
+                    if kind == "error":
+                        raise payload
+                    if kind == "done":
+                        return
+                    yield payload
+            finally:
+                for attempt in race.attempts:
+                    attempt.cancel()
+
+        start(race.candidates[0])
+        race.routed._parts = parts()
+        return race.routed
+
+    def astream(
+        self, model: TextModel, messages: list, prompt_tokens: int = 0, **kwargs
+    ) -> RoutedStream:
+        """`stream` on the running event loop, with a task per attempt."""
+        race = self._race(model, prompt_tokens)
+        events: asyncio.Queue = asyncio.Queue()
+
+        async def pump(attempt: _Attempt, messages: list) -> None:
+            try:
+                response = await self.acompletion(  # type: ignore
+                    model=attempt.model.value, messages=messages, stream=True, **kwargs
+                )
+                async for part in response:
+                    if attempt.on_part(part):
+                        events.put_nowait(("chunk", attempt, part))
+                events.put_nowait(("done", attempt, None))
+            except Exception as e:
+                attempt.failed = True
+                events.put_nowait(("error", attempt, e))
+            finally:
+                self._record(attempt)
+
+        def start(candidate: TextModel) -> None:
+            attempt = _Attempt(candidate)
+            race.attempts.append(attempt)
+            attempt.task = asyncio.create_task(
+                pump(attempt, self._messages_for(candidate, model, messages))
+            )
+
+        async def parts() -> AsyncIterator[Any]:
+            try:
+                while True:
+                    try:
+                        kind, attempt, payload = await asyncio.wait_for(
+                            events.get(), race.timeout()
+                        )
+                    except asyncio.TimeoutError:
+                        start(race.on_timeout())
+                        continue
+                    fallback = race.on_event(kind, attempt, payload)
+                    if fallback is not None:
+                        start(fallback)
+                    if attempt is not race.winner:
+                        continue
+                    if kind == "error":
+                        raise payload
+                    if kind == "done":
+                        return
+                    yield payload
+            finally:
+                for attempt in race.attempts:
+                    attempt.cancel()
+
+        start(race.candidates[0])
+        race.routed._parts = parts()
+        return race.routed
+
+
+def describe_stats(stats: dict[str, dict[str, Any]]) -> str:
+    """Slack text for the output of `ModelRouter.stats`."""
+    if not stats:
+        return "No model has been called since this instance started."
+    lines = []
+    for model, s in sorted(stats.items()):
+        line = f"- {model}: {s['requests']} requests, {s['error_rate']:.0%} failed"
+        if s["ttft_p50_s"] is not None:
+            line += (
+                f", first token in {s['ttft_p50_s']:.1f}s"
+                f" (p90 {s['ttft_p90_s']:.1f}s)"
+            )
+        if s["tokens_per_s"]:
+            line += f", {s['tokens_per_s']:.0f} tokens/s"
+        if s["hedged_out"]:
+            line += f", overtaken by a hedge {s['hedged_out']} times"
+        lines.append(line)
+    return "Recent model performance:\n" + "\n".join(lines)
@@ -1,44 +1,292 @@
+import hashlib
+import io
+import logging
+import mmap
+import multiprocessing
 import os
-from io import BytesIO, StringIO
-
-import requests  # type: ignore
-from pdfminer.converter import TextConverter
-from pdfminer.layout import LAParams
-from pdfminer.pdfdocument import PDFDocument
-from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
-from pdfminer.pdfpage import PDFPage
-from pdfminer.pdfparser import PDFParser
+import tempfile
+import time
+from multiprocessing.connection import Connection, wait
+from multiprocessing.process import BaseProcess
+from typing import BinaryIO, Generator, Iterator, cast
 
 import s3_cache
+import telemetry
+from fetcher import download
 
+logger = logging.getLogger(__name__)
 BOT_TOKEN = os.environ.get("SLACK_BOT_TOKEN")
 CACHE_NAMESPACE = "pdf_utils"
 s3_cache.set_max_size(CACHE_NAMESPACE, 100)
+# Pages are cached by document content and extraction mode, so a retry after the
+# time budget ran out, or the same file shared again, only extracts what's missing
+PAGE_CACHE_NAMESPACE = "pdf_pages"
+s3_cache.set_max_size(PAGE_CACHE_NAMESPACE, 5000)
 
+MAX_PAGES = int(os.environ.get("PDF_MAX_PAGES", 150))
+# Stay inside the enrichment job timeout, so whatever was extracted gets used
+TIME_BUDGET_S = float(os.environ.get("PDF_TIME_BUDGET_S", 15))
+MAX_WORKERS = int(os.environ.get("PDF_MAX_WORKERS", os.cpu_count() or 1))
+# Skip layout analysis: much faster, but words and lines can run together
+FAST_MODE = os.environ.get("PDF_FAST_MODE", "").lower() in ("1", "true", "yes")
+PAGES_PER_CHUNK = 4
+# Below this, starting workers costs more than it saves
+MIN_PARALLEL_PAGES = 8
+# Workers start from a fork server rather than forking the handler, which runs
+# threads. It imports these once, so each worker starts without reimporting them.
+PRELOAD_MODULES = ["pdf_utils", "pdfminer.pdfinterp", "pdfminer.converter"]
 
-def extract_text_from_pdf(pdf_url):
-    cached_text = s3_cache.get_cache(CACHE_NAMESPACE, pdf_url)
-    if cached_text:
-        return cached_text
 
-    response = requests.get(pdf_url, headers={"Authorization": f"Bearer {BOT_TOKEN}"})
-    if response.status_code != 200:
-        raise Exception(
-            f"Error downloading file [{pdf_url}]. HTTP request status: {response.status_code}"
-        )
-    pdf_content = BytesIO(response.content)
-    parser = PDFParser(pdf_content)
-    document = PDFDocument(parser)
+class PdfExtractionError(Exception):
+    pass
+
+
+def _reader(pdf: BinaryIO) -> BinaryIO:
+    """
+    Open a private read handle on `pdf`, so parsers never share a file position.
+
+    Files are memory-mapped, so even large PDFs are paged in from /tmp by the OS
+    rather than copied into Python objects.
+    """
+    try:
+        pdf.flush()
+        return mmap.mmap(pdf.fileno(), 0, access=mmap.ACCESS_READ)  # type: ignore
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        pdf.seek(0)
+        return io.BytesIO(pdf.read())
+
+
+def _digest(pdf: BinaryIO) -> str:
+    digest = hashlib.sha256()
+    pdf.seek(0)
+    for chunk in iter(lambda: pdf.read(1024 * 1024), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _page_texts(
+    pdf: BinaryIO, pages: set[int], fast: bool
+) -> Generator[tuple[int, str], None, None]:
+    """Extract the text of the given 0-based pages of a PDF, in document order."""
+    # pdfminer is slow to import, and most sessions never see a PDF
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.pdfparser import PDFParser
+
+    fp = _reader(pdf)
+    document = PDFDocument(PDFParser(fp))
     rsrcmgr = PDFResourceManager()
-    text_output = StringIO()
-    device = TextConverter(rsrcmgr, text_output, laparams=LAParams())
+    text_output = io.StringIO()
+    device = TextConverter(rsrcmgr, text_output, laparams=None if fast else LAParams())
     interpreter = PDFPageInterpreter(rsrcmgr, device)
-    for page in PDFPage.create_pages(document):
-        interpreter.process_page(page)
+    last_page = max(pages, default=-1)
+    try:
+        for page_no, page in enumerate(PDFPage.create_pages(document)):
+            if page_no > last_page:
+                break
+            if page_no not in pages:
+                continue
+            interpreter.process_page(page)
+            # TextConverter ends every page with a form feed
+            yield page_no, text_output.getvalue().rstrip("\f").strip()
+            text_output.seek(0)
+            text_output.truncate()
+    finally:
+        device.close()
+        text_output.close()
+        fp.close()
+
+
+def count_pages(pdf: BinaryIO) -> int:
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.pdfparser import PDFParser
+
+    with _reader(pdf) as fp:
+        document = PDFDocument(PDFParser(fp))
+        return sum(1 for _ in PDFPage.create_pages(document))
+
 
-    text = text_output.getvalue()
-    device.close()
-    text_output.close()
+def _worker(conn: Connection, path: str, pages: set[int], fast: bool) -> None:
+    """
+    Child process: send `(page_no, text)` for each page as soon as it's done, then
+    `None` once all are, or the error message as a `str` if extraction failed.
+    """
+    done: str | None = None
+    try:
+        with open(path, "rb") as pdf:
+            for page_no, text in _page_texts(pdf, pages, fast):
+                conn.send((page_no, text))
+    except Exception as e:
+        logger.error(f"PDF worker failed: {str(e)}")
+        done = str(e) or type(e).__name__
+    finally:
+        try:
+            conn.send(done)
+        except OSError:
+            pass  # The parent gave up on us
+        conn.close()
+
+
+def _extract_parallel(
+    pdf: BinaryIO, pages: list[int], fast: bool, workers: int, deadline: float
+) -> Generator[tuple[int, str], None, None]:
+    """
+    Extract `pages` across worker processes, yielding them as they finish.
+
+    Uses bare `Process` and `Pipe`: Lambda has no `/dev/shm`, which the semaphores
+    behind `multiprocessing.Pool` need. Small chunks of consecutive pages are dealt
+    out round-robin, so whatever is done when the deadline hits is close to a prefix
+    of the document. Workers still running then are terminated.
+
+    Workers read the PDF from a copy in /tmp, since a fork server child can't
+    inherit the open file. Raises `PdfExtractionError` if a worker fails.
+    """
+    chunks = [
+        pages[i : i + PAGES_PER_CHUNK] for i in range(0, len(pages), PAGES_PER_CHUNK)
+    ]
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(PRELOAD_MODULES)
+    running: dict[Connection, BaseProcess] = {}
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as copy:
+        pdf.seek(0)
+        for chunk in iter(lambda: pdf.read(1024 * 1024), b""):
+            copy.write(chunk)
+        copy.flush()
+        try:
+            for i in range(workers):
+                assigned = {page for chunk in chunks[i::workers] for page in chunk}
+                receiver, sender = context.Pipe(duplex=False)
+                process: BaseProcess = context.Process(
+                    target=_worker,
+                    args=(sender, copy.name, assigned, fast),
+                    daemon=True,
+                )
+                process.start()
+                sender.close()
+                running[receiver] = process
+
+            while running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for ready in wait(list(running), timeout=remaining):
+                    conn = cast(Connection, ready)
+                    try:
+                        message = conn.recv()
+                    except EOFError:
+                        message = "worker exited"
+                    if isinstance(message, str):
+                        raise PdfExtractionError(message)
+                    if message is None:
+                        running.pop(conn).join()
+                        conn.close()
+                    else:
+                        yield message
+        finally:
+            for conn, process in running.items():
+                process.terminate()
+                process.join()
+                conn.close()
+
+
+def iter_pdf_pages(
+    pdf: BinaryIO,
+    max_pages: int = MAX_PAGES,
+    time_budget: float = TIME_BUDGET_S,
+    fast: bool = FAST_MODE,
+    workers: int = MAX_WORKERS,
+    total_pages: int | None = None,
+) -> Iterator[tuple[int, str]]:
+    """
+    Stream `(page_number, text)` for the first `max_pages` pages of a PDF, in page
+    order and numbered from 1.
+
+    Cached pages are served from the page cache and the rest are extracted in
+    parallel until `time_budget` runs out. Extraction stops at the first page that
+    isn't done by then. Newly extracted pages are cached even if never yielded.
+    """
+    deadline = time.monotonic() + time_budget
+    digest = _digest(pdf)
+    mode = "fast" if fast else "layout"
+    if total_pages is None:
+        total_pages = count_pages(pdf)
+    pages = list(range(min(total_pages, max_pages)))
+    keys = {page_no: f"{digest}/{mode}/{page_no}" for page_no in pages}
+    cached = s3_cache.get_many(PAGE_CACHE_NAMESPACE, keys.values())
+    done = {p: cached[keys[p]] for p in pages if keys[p] in cached}
+    missing = [p for p in pages if p not in done]
+
+    extracted: dict[int, str] = {}
+    results: Generator[tuple[int, str], None, None]
+    if len(missing) < MIN_PARALLEL_PAGES or workers <= 1:
+        results = _page_texts(pdf, set(missing), fast)
+    else:
+        results = _extract_parallel(pdf, missing, fast, workers, deadline)
+    next_page = 0
+    try:
+        for page_no, text in results:
+            extracted[page_no] = done[page_no] = text
+            while next_page in done:
+                yield next_page + 1, done[next_page]
+                next_page += 1
+            if time.monotonic() > deadline:
+                break
+        while next_page in done:
+            yield next_page + 1, done[next_page]
+            next_page += 1
+    finally:
+        results.close()
+        s3_cache.set_many(
+            PAGE_CACHE_NAMESPACE,
+            {keys[page_no]: text for page_no, text in extracted.items()},
+        )
+
+
+def extract_pdf_text(
+    pdf: BinaryIO,
+    max_pages: int = MAX_PAGES,
+    time_budget: float = TIME_BUDGET_S,
+    fast: bool = FAST_MODE,
+    workers: int = MAX_WORKERS,
+) -> tuple[str, bool]:
+    """
+    Join the pages of a PDF under `[Page N]` markers. Returns the text and whether
+    extraction finished within the time budget. A closing marker says where and why
+    it stopped if any pages were left out.
+    """
+    total = count_pages(pdf)
+    pages = iter_pdf_pages(pdf, max_pages, time_budget, fast, workers, total)
+    parts: list[str] = []
+    reason = "out of time"
+    try:
+        for page_no, text in pages:
+            parts.append(f"[Page {page_no}]\n{text}")
+    except PdfExtractionError as e:
+        logger.error(f"Error extracting PDF text: {str(e)}")
+        reason = "extraction error"
+    extracted = len(parts)
+    limit = min(total, max_pages)
+    if extracted < limit:
+        parts.append(f"[Stopped at page {extracted} of {total}: {reason}]")
+    elif limit < total:
+        parts.append(f"[Stopped at page {limit} of {total}: page limit]")
+    return "\n\n".join(parts), extracted == limit
+
+
+def extract_text_from_pdf(pdf_url):
+    cached_text = s3_cache.get_cache(CACHE_NAMESPACE, pdf_url)
+    if cached_text:
+        return cached_text
 
-    s3_cache.set_cache(CACHE_NAMESPACE, pdf_url, text)
+    with download(pdf_url, headers={"Authorization": f"Bearer {BOT_TOKEN}"}) as pdf:
+        with telemetry.span("PdfExtractLatency"):
+            text, finished = extract_pdf_text(pdf)
+    # Text cut short by the time budget isn't cached whole; the page cache keeps
+    # the progress, so the next attempt picks up from there
+    if finished:
+        s3_cache.set_cache(CACHE_NAMESPACE, pdf_url, text)
     return text
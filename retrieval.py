@@ -0,0 +1,270 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable
+
+import s3_cache
+from context_packer import ATTACHMENT_BLOCK
+from local_cache import MemoryLRU
+from messages import ChatMessage
+
+logger = logging.getLogger(__name__)
+CACHE_NAMESPACE = "retrieval_index"
+s3_cache.set_max_size(CACHE_NAMESPACE, 500)
+INDEX_VERSION = 1
+
+# Attachments shorter than this go into the prompt whole
+MIN_CHARS = int(os.environ.get("RETRIEVAL_MIN_CHARS", 24_000))
+TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", 8))
+CHUNK_CHARS = 1500
+BM25_K1 = 1.5
+BM25_B = 0.75
+TOKEN = re.compile(r"\w{2,}")
+STOPWORDS = frozenset(
+    "a an and are as at be but by can did do does for from had has have he her his "
+    "how i if in into is it its me my no not of on or our she so than that the their "
+    "them then there these they this to was we were what when where which who why "
+    "will with would you your".split()
+)
+# Questions that need an attachment whole, rather than its digest or excerpts
+FULL_TEXT = re.compile(
+    r"\b(full|entire|whole|complete) (text|document|transcript|article|file|pdf|page)\b"
+    r"|\bverbatim\b|\bword for word\b",
+    re.IGNORECASE,
+)
+# Built indexes of recently used attachments, sized by their text
+indexes = MemoryLRU(32 * 1024 * 1024)
+
+
+def tokenize(text: str) -> list[str]:
+    return [t for t in TOKEN.findall(text.lower()) if t not in STOPWORDS]
+
+
+@dataclass
+class ChunkIndex:
+    """
+    BM25 index over the chunks of one attachment.
+
+    :param spans: `(start, end)` offsets of each chunk in the attachment text.
+    :param term_freqs: Term counts of each chunk.
+    :param doc_freqs: Number of chunks each term appears in.
+    """
+
+    spans: list[tuple[int, int]]
+    term_freqs: list[dict[str, int]]
+    doc_freqs: dict[str, int]
+
+    @classmethod
+    def build(cls, text: str) -> "ChunkIndex":
+        spans = chunk_spans(text)
+        term_freqs = [dict(Counter(tokenize(text[s:e]))) for s, e in spans]
+        doc_freqs: Counter = Counter()
+        for tf in term_freqs:
+            doc_freqs.update(tf.keys())
+        return cls(spans, term_freqs, dict(doc_freqs))
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "version": INDEX_VERSION,
+                "spans": self.spans,
+                "term_freqs": self.term_freqs,
+                "doc_freqs": self.doc_freqs,
+            },
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, data: str) -> "ChunkIndex":
+        parsed = json.loads(data)
+        if parsed.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported index version {parsed.get('version')}")
+        spans = [(start, end) for start, end in parsed["spans"]]
+        return cls(spans, parsed["term_freqs"], parsed["doc_freqs"])
+
+    def scores(self, query: str) -> list[float]:
+        terms = set(tokenize(query))
+        lengths = [sum(tf.values()) for tf in self.term_freqs]
+        avg_length = sum(lengths) / max(len(lengths), 1) or 1
+        n = len(self.spans)
+        scores = [0.0] * n
+        for term in terms:
+            df = self.doc_freqs.get(term)
+            if not df:
+                continue
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for i, tf in enumerate(self.term_freqs):
+                freq = tf.get(term)
+                if freq:
+                    norm = 1 - BM25_B + BM25_B * lengths[i] / avg_length
+                    scores[i] += idf * freq * (BM25_K1 + 1) / (freq + BM25_K1 * norm)
+        return scores
+
+
+def chunk_spans(text: str, chunk_chars: int = CHUNK_CHARS) -> list[tuple[int, int]]:
+    """Split `text` into chunks of about `chunk_chars`, at line breaks where possible."""
+    spans = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_chars, len(text))
+        if end < len(text):
+            # Break after the last line in the second half of the chunk, if any
+            newline = text.rfind("\n", start + chunk_chars // 2, end)
+            if newline > 0:
+                end = newline + 1
+        spans.append((start, end))
+        start = end
+    return spans
+
+
+def get_index(text: str) -> ChunkIndex:
+    """Load the index of `text` from memory or the cache, building it on a miss."""
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    index = indexes.get(key)
+    if index is not None:
+        return index
+    cached = s3_cache.get_cache(CACHE_NAMESPACE, key)
+    try:
+        index = ChunkIndex.from_json(cached) if cached else None
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f"Rebuilding unreadable retrieval index: {str(e)}")
+    if index is None:
+        index = ChunkIndex.build(text)
+        s3_cache.set_cache(CACHE_NAMESPACE, key, index.to_json())
+    indexes.put(key, index, len(text))
+    return index
+
+
+def select_chunks(text: str, query: str, top_k: int = TOP_K) -> str | None:
+    """
+    Keep the opening chunk of `text` plus the `top_k` chunks that best match
+    `query`, in document order. Returns None when nothing matches, since a query
+    like "summarize this" needs the whole text.
+    """
+    index = get_index(text)
+    scores = index.scores(query)
+    ranked = sorted(
+        (i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i]
+    )
+    if not ranked:
+        return None
+    chosen = sorted(set(ranked[:top_k]) | {0})
+    total = len(index.spans)
+    parts = [
+        f"[Showing {len(chosen)} of {total} sections, picked for relevance to the "
+        "latest message. Ask about other parts to see them.]"
+    ]
+    for i in chosen:
+        start, end = index.spans[i]
+        parts.append(f"[Section {i + 1}/{total}]\n{text[start:end].strip()}")
+    return "\n\n".join(parts)
+
+
+def _pinned(body: str, digest: str | None) -> str:
+    """What stays of an attachment `body` in an earlier message, whatever the query."""
+    if digest is not None:
+        head = f"[Digest of the whole document]\n{digest}"
+    else:
+        spans = get_index(body).spans
+        start, end = spans[0]
+        head = f"[Section 1/{len(spans)}]\n{body[start:end].strip()}"
+    return (
+        f"{head}\n\n[Parts of this document relevant to the latest message are "
+        "shown with it. Ask about specific parts, or for the full text, to see them.]"
+    )
+
+
+def focus_attachments(
+    msg: ChatMessage,
+    query: str,
+    digests: Callable[[str], str | None] | None = None,
+) -> ChatMessage:
+    """
+    Replace large attachment blocks in `msg` with what `query` needs of them: their
+    digest from `digests`, if it has one, and the chunks relevant to `query`. Asking
+    for the full text keeps the blocks whole.
+    """
+    full_text = FULL_TEXT.search(query) is not None
+
+    def focus(match: re.Match) -> str:
+        tag, attrs, body = match.groups()
+        if len(body) < MIN_CHARS or full_text:
+            return match.group(0)
+        digest = digests(body) if digests else None
+        selected = select_chunks(body, query)
+        if digest is None and selected is None:
+            return match.group(0)
+        parts = []
+        if digest is not None:
+            parts.append(f"[Digest of the whole document]\n{digest}")
+            if selected is None:
+                parts.append(
+                    "[Only the digest is shown. Ask about specific parts, or for the "
+                    "full text, to see them.]"
+                )
+        if selected is not None:
+            parts.append(selected)
+        focused = "\n\n".join(parts)
+        logger.info(f"Focused <{tag}{attrs}>: {len(body)} -> {len(focused)}")
+        return f"<{tag}{attrs}>\n{focused}\n</{tag}>"
+
+    content = ATTACHMENT_BLOCK.sub(focus, msg.content)
+    if content == msg.content:
+        return msg
+    return ChatMessage(content, msg.role, msg.name, dict(msg.meta))
+
+
+def focus_history(
+    messages: list[ChatMessage],
+    query: str,
+    digests: Callable[[str], str | None] | None = None,
+) -> list[ChatMessage]:
+    """
+    `focus_attachments` over a conversation whose latest message is `query`, keeping
+    the earlier messages the same from turn to turn so provider prompt caches hold.
+
+    Large blocks in earlier messages are pinned to their digest, or their opening
+    section until the digest is written. What `query` needs of them, whether
+    excerpts or the whole text, is appended to the latest message instead.
+    """
+    if not messages:
+        return messages
+    *earlier, latest = messages
+    full_text = FULL_TEXT.search(query) is not None
+    # Blocks to append to the latest message, once per distinct attachment
+    needed: dict[str, str] = {}
+
+    def pin(match: re.Match) -> str:
+        tag, attrs, body = match.groups()
+        if len(body) < MIN_CHARS:
+            return match.group(0)
+        digest = digests(body) if digests else None
+        if full_text:
+            extra = body
+        else:
+            # Nothing matching, as in "summarize this", needs the whole text unless
+            # the digest pinned in place covers it
+            extra = select_chunks(body, query) or (None if digest else body)
+        if extra is not None:
+            needed.setdefault(body, f"<{tag}{attrs}>\n{extra}\n</{tag}>")
+        return f"<{tag}{attrs}>\n{_pinned(body, digest)}\n</{tag}>"
+
+    focused = []
+    for msg in earlier:
+        content = ATTACHMENT_BLOCK.sub(pin, msg.content)
+        if content != msg.content:
+            msg = ChatMessage(content, msg.role, msg.name, dict(msg.meta))
+        focused.append(msg)
+    latest = focus_attachments(latest, query, digests)
+    if needed:
+        logger.info(
+            f"Showing {len(needed)} earlier attachments with the latest message"
+        )
+        content = "\n\n".join([latest.content, *needed.values()])
+        latest = ChatMessage(content, latest.role, latest.name, dict(latest.meta))
+    return [*focused, latest]
@@ -1,96 +1,598 @@
-import boto3  # type: ignore
+import gzip
+import hashlib
+import json
 import os
+import struct
+import threading
 import time
 from aws_lambda_powertools import Logger
-from typing import Dict
+from datetime import datetime
+from botocore.exceptions import ClientError  # type: ignore
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit, urlunsplit
+
+import telemetry
+from local_cache import DiskCache, MemoryLRU
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None  # type: ignore[assignment]
 
 logger = Logger()
 
-s3_client = boto3.client("s3")
+# Upper bound on concurrent S3 requests from get_many/set_many. The client's
+# connection pool is sized to match so batched calls don't queue for sockets.
+MAX_CONCURRENCY = int(os.environ.get("S3_CACHE_MAX_CONCURRENCY", 16))
+_s3_client = None
+_client_lock = threading.Lock()
 S3_BUCKET = os.environ.get("S3_BUCKET_NAME", "your-default-bucket-name")
 CACHE_PREFIX = "cache/"
 MAX_SIZES: Dict[str, int] = {}
+# Namespaces holding mutable records that must always be read from S3, since a
+# local copy in another warm environment could be stale
+REMOTE_ONLY: set[str] = set()
+
+# Stored bodies start with a fixed header: magic, format version, codec and write
+# time. Anything without the magic is a legacy entry holding raw UTF-8.
+FORMAT_MAGIC = b"\x00SC"
+FORMAT_VERSION = 2
+CODEC_NONE = b"n"
+CODEC_GZIP = b"g"
+CODEC_ZSTD = b"z"
+CACHE_CODEC = os.environ.get("CACHE_CODEC", "zstd" if zstandard else "gzip")
+MIN_COMPRESS_BYTES = 512
+_HEADER = struct.Struct(">3sBcQ")
+# Namespaces that stored entries under their raw keys before the versioned format.
+# A miss there also tries the raw key, until the migration window closes. ytsubs is
+# left out: its keys changed from URLs to video ids, so old entries never match.
+LEGACY_NAMESPACES = frozenset({"web_reader", "pdf_utils"})
+LEGACY_READS_UNTIL = datetime.fromisoformat(
+    os.environ.get("CACHE_LEGACY_READS_UNTIL", "2027-01-01T00:00:00+00:00")
+).timestamp()
+
+# Each size-limited namespace keeps an index object of {name: [size, last_access]},
+# so eviction never has to list or HEAD the entries themselves.
+INDEX_NAME = "_index.json"
+INDEX_VERSION = 1
+INDEX_MAX_AGE_S = 24 * 60 * 60  # Rebuild from a listing once a day to catch drift
+INDEX_WRITE_ATTEMPTS = 3
+# Writes only evict once a namespace is this fraction over its max size
+EVICTION_SLACK = 0.1
+# Writes are merged into the index in batches: once this many are pending in a
+# namespace, or when `flush_indexes` runs at the end of a turn
+INDEX_BATCH_WRITES = int(os.environ.get("CACHE_INDEX_BATCH_WRITES", 50))
+
+# A cached value and the unix time it was stored at
+CacheEntry = tuple[str, float]
+
+# Accesses served and entries written since the last index write, merged in on
+# the next one. Writes are {name: (size, written_at)}.
+_pending_access: Dict[str, Dict[str, int]] = {}
+_pending_writes: Dict[str, Dict[str, tuple[int, int]]] = {}
+_pending_lock = threading.Lock()
+
+# Read-through tiers in front of S3: process memory, then local disk, then S3.
+# Both local tiers live for as long as the Lambda execution environment stays warm.
+memory_tier = MemoryLRU(int(os.environ.get("CACHE_MEMORY_MAX_BYTES", 64 * 1024 * 1024)))
+disk_tier = DiskCache(
+    os.environ.get("CACHE_DISK_DIR", "/tmp/s3_cache"),
+    int(os.environ.get("CACHE_DISK_MAX_BYTES", 256 * 1024 * 1024)),
+)
+
+
+def s3_client():
+    """
+    Return the shared S3 client, creating it on first use.
+
+    Importing boto3 and building a client takes a noticeable part of a cold start,
+    and many invocations never reach S3 at all.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _client_lock:
+            if _s3_client is None:
+                import boto3  # type: ignore
+                from botocore.config import Config  # type: ignore
+
+                _s3_client = boto3.client(
+                    "s3", config=Config(max_pool_connections=MAX_CONCURRENCY)
+                )
+    return _s3_client
+
+
+def _normalize_key(key: str) -> str:
+    """Canonicalize URL keys so trivially different spellings share an entry."""
+    key = key.strip()
+    parts = urlsplit(key)
+    scheme = parts.scheme.lower()
+    if scheme not in ("http", "https") or not parts.netloc:
+        return key
+    netloc = parts.netloc.lower()
+    default_port = ":80" if scheme == "http" else ":443"
+    if netloc.endswith(default_port):
+        netloc = netloc[: -len(default_port)]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+def _namespace_prefix(namespace: str) -> str:
+    return f"{CACHE_PREFIX}{namespace}/"
 
 
 def _get_full_key(namespace: str, key: str) -> str:
-    return f"{CACHE_PREFIX}{namespace}/{key}"
+    digest = hashlib.sha256(_normalize_key(key).encode("utf-8")).hexdigest()
+    return f"{_namespace_prefix(namespace)}v{FORMAT_VERSION}/{digest}"
 
 
-def get_cache(namespace: str, key: str) -> str | None:
-    full_key = _get_full_key(namespace, key)
-    try:
-        response = s3_client.get_object(Bucket=S3_BUCKET, Key=full_key)
-        return response["Body"].read().decode("utf-8")
-    except s3_client.exceptions.NoSuchKey:
-        logger.info(f"Cache miss for key: {full_key}")
+def _legacy_key(namespace: str, key: str) -> str:
+    return f"{_namespace_prefix(namespace)}{key}"
+
+
+def _reads_legacy(namespace: str) -> bool:
+    return namespace in LEGACY_NAMESPACES and time.time() < LEGACY_READS_UNTIL
+
+
+def _index_key(namespace: str) -> str:
+    return f"{_namespace_prefix(namespace)}{INDEX_NAME}"
+
+
+def _entry_name(namespace: str, full_key: str) -> str:
+    return full_key[len(_namespace_prefix(namespace)) :]
+
+
+def _encode(value: str, stored_at: float | None = None) -> bytes:
+    payload = value.encode("utf-8")
+    codec = CODEC_NONE
+    if len(payload) >= MIN_COMPRESS_BYTES:
+        if CACHE_CODEC == "zstd" and zstandard is not None:
+            payload = zstandard.ZstdCompressor(level=3).compress(payload)
+            codec = CODEC_ZSTD
+        elif CACHE_CODEC != "none":
+            payload = gzip.compress(payload, compresslevel=6)
+            codec = CODEC_GZIP
+    if stored_at is None:
+        stored_at = time.time()
+    header = _HEADER.pack(FORMAT_MAGIC, FORMAT_VERSION, codec, int(stored_at))
+    return header + payload
+
+
+def _decode(body: bytes) -> tuple[str, int, float]:
+    """
+    Return the value stored in `body`, its uncompressed size and when it was stored.
+    Legacy entries don't record that, and report 0.
+    """
+    if not body.startswith(FORMAT_MAGIC):
+        return body.decode("utf-8"), len(body), 0.0
+    _, version, codec, stored_at = _HEADER.unpack_from(body)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported cache format version {version}")
+    payload = body[_HEADER.size :]
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("Entry is zstd-compressed but zstandard is not installed")
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    elif codec == CODEC_GZIP:
+        payload = gzip.decompress(payload)
+    elif codec != CODEC_NONE:
+        raise ValueError(f"Unknown cache codec {codec!r}")
+    return payload.decode("utf-8"), len(payload), float(stored_at)
+
+
+def _record_access(namespace: str, full_key: str) -> None:
+    if namespace not in MAX_SIZES:
+        return
+    with _pending_lock:
+        _pending_access.setdefault(namespace, {})[_entry_name(namespace, full_key)] = (
+            int(time.time())
+        )
+
+
+def _set_local(namespace: str, full_key: str, body: bytes) -> CacheEntry:
+    value, size, stored_at = _decode(body)
+    if namespace in REMOTE_ONLY:
+        return value, stored_at
+    memory_tier.put(full_key, (value, stored_at), size)
+    disk_tier.put(full_key, body)
+    return value, stored_at
+
+
+def _delete_local(full_key: str) -> None:
+    memory_tier.delete(full_key)
+    disk_tier.delete(full_key)
+
+
+def _get_local(namespace: str, full_key: str) -> CacheEntry | None:
+    if namespace in REMOTE_ONLY:
         return None
+    entry = memory_tier.get(full_key)
+    if entry is not None:
+        _record_access(namespace, full_key)
+        telemetry.count("CacheHits", namespace=namespace, tier="memory")
+        return entry
+    body = disk_tier.get(full_key)
+    if body is not None:
+        try:
+            # Promote to the memory tier
+            value, size, stored_at = _decode(body)
+            memory_tier.put(full_key, (value, stored_at), size)
+            _record_access(namespace, full_key)
+            telemetry.count("CacheHits", namespace=namespace, tier="disk")
+            return value, stored_at
+        except Exception as e:
+            logger.error(f"Dropping unreadable disk entry for {full_key}: {str(e)}")
+            disk_tier.delete(full_key)
+    return None
+
+
+def _get_remote(namespace: str, key: str, full_key: str) -> CacheEntry | None:
+    try:
+        with telemetry.span("CacheS3GetLatency", namespace=namespace):
+            response = s3_client().get_object(Bucket=S3_BUCKET, Key=full_key)
+            body = response["Body"].read()
+        entry = _set_local(namespace, full_key, body)
+        _record_access(namespace, full_key)
+        telemetry.count("CacheHits", namespace=namespace, tier="s3")
+        return entry
+    except s3_client().exceptions.NoSuchKey:
+        pass
     except Exception as e:
         logger.error(f"Error retrieving cache for key {full_key}: {str(e)}")
         return None
 
+    legacy = _get_legacy(namespace, key) if _reads_legacy(namespace) else None
+    if legacy is None:
+        logger.info(f"Cache miss for key: {full_key}")
+        telemetry.count("CacheMisses", namespace=namespace)
+        return None
+    telemetry.count("CacheHits", namespace=namespace, tier="legacy")
+    return legacy
+
 
-def set_cache(namespace: str, key: str, value: str) -> None:
+def get_entry(namespace: str, key: str) -> CacheEntry | None:
+    """Like `get_cache`, but also return when the value was stored (0 if unknown)."""
     full_key = _get_full_key(namespace, key)
+    entry = _get_local(namespace, full_key)
+    if entry is not None:
+        return entry
+    return _get_remote(namespace, key, full_key)
+
+
+def get_cache(namespace: str, key: str) -> str | None:
+    entry = get_entry(namespace, key)
+    return entry[0] if entry else None
+
+
+def get_many(
+    namespace: str, keys: Iterable[str], max_workers: int | None = None
+) -> Dict[str, str]:
+    """
+    Look up several keys at once. Local tiers are checked first and the remaining
+    keys are fetched from S3 concurrently. Keys that miss or fail are left out of
+    the result.
+    """
+    results: Dict[str, str] = {}
+    remote: Dict[str, str] = {}
+    for key in keys:
+        full_key = _get_full_key(namespace, key)
+        entry = _get_local(namespace, full_key)
+        if entry is not None:
+            results[key] = entry[0]
+        else:
+            remote[key] = full_key
+    if not remote:
+        return results
+
+    workers = min(max_workers or MAX_CONCURRENCY, len(remote))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            key: executor.submit(_get_remote, namespace, key, full_key)
+            for key, full_key in remote.items()
+        }
+        for key, future in futures.items():
+            entry = future.result()
+            if entry is not None:
+                results[key] = entry[0]
+    return results
+
+
+def _get_legacy(namespace: str, key: str) -> CacheEntry | None:
+    """
+    Read an entry written before the versioned format and migrate it, keeping the
+    time it was originally stored so it doesn't look fresher than it is.
+    """
+    legacy_key = _legacy_key(namespace, key)
     try:
-        s3_client.put_object(
+        response = s3_client().get_object(Bucket=S3_BUCKET, Key=legacy_key)
+        value, _, _ = _decode(response["Body"].read())
+        timestamp = response.get("Metadata", {}).get("timestamp")
+        if timestamp is not None:
+            stored_at = float(timestamp)
+        else:
+            stored_at = response["LastModified"].timestamp()
+        logger.info(f"Migrating legacy cache entry: {legacy_key}")
+        _store(namespace, key, value, stored_at)
+        return value, stored_at
+    except s3_client().exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        logger.error(f"Error reading legacy cache entry {legacy_key}: {str(e)}")
+        return None
+
+
+def _put_remote(key: str, full_key: str, body: bytes) -> bool:
+    try:
+        s3_client().put_object(
             Bucket=S3_BUCKET,
             Key=full_key,
-            Body=value.encode("utf-8"),
-            Metadata={"timestamp": str(int(time.time()))},
+            Body=body,
+            Metadata={
+                "timestamp": str(int(time.time())),
+                "format": str(FORMAT_VERSION),
+                # User metadata is ASCII-only and capped at 2KB per object
+                "source-key": quote(key, safe=":/?&=%#+@,;")[:1024],
+            },
         )
         logger.info(f"Cache set for key: {full_key}")
-
-        # Enforce size limit if set for the namespace
-        if namespace in MAX_SIZES:
-            enforce_size_limit(namespace)
+        return True
     except Exception as e:
         logger.error(f"Error setting cache for key {full_key}: {str(e)}")
+        return False
+
+
+def _track_writes(namespace: str, writes: Dict[str, int]) -> None:
+    # Queue the entries for the namespace index, merging them in once enough are due
+    if namespace not in MAX_SIZES or not writes:
+        return
+    now = int(time.time())
+    with _pending_lock:
+        pending = _pending_writes.setdefault(namespace, {})
+        pending.update({name: (size, now) for name, size in writes.items()})
+        due = len(pending) >= INDEX_BATCH_WRITES
+    if due:
+        _flush_index(namespace)
+
+
+def _flush_index(namespace: str) -> None:
+    limit = int(MAX_SIZES[namespace] * (1 + EVICTION_SLACK))
+    with telemetry.span("CacheIndexUpdateLatency", namespace=namespace):
+        _update_index(namespace, limit)
+
+
+def flush_indexes() -> None:
+    """
+    Merge the writes queued so far into their namespace indexes, evicting where a
+    namespace grew too large. Called once a turn has replied, so the index round
+    trips stay off the reply path.
+    """
+    with _pending_lock:
+        namespaces = [ns for ns, writes in _pending_writes.items() if writes]
+    for namespace in namespaces:
+        _flush_index(namespace)
+
+
+def set_cache(namespace: str, key: str, value: str) -> None:
+    _store(namespace, key, value)
+
+
+def _store(
+    namespace: str, key: str, value: str, stored_at: float | None = None
+) -> None:
+    full_key = _get_full_key(namespace, key)
+    body = _encode(value, stored_at)
+    _set_local(namespace, full_key, body)
+    if _put_remote(key, full_key, body):
+        _track_writes(namespace, {_entry_name(namespace, full_key): len(body)})
+
+
+def set_many(
+    namespace: str, items: Dict[str, str], max_workers: int | None = None
+) -> list[str]:
+    """
+    Store several values at once with concurrent S3 writes and a single index
+    update. Returns the keys that were written successfully.
+    """
+    if not items:
+        return []
+    bodies: Dict[str, tuple[str, bytes]] = {}
+    for key, value in items.items():
+        full_key = _get_full_key(namespace, key)
+        body = _encode(value)
+        _set_local(namespace, full_key, body)
+        bodies[key] = (full_key, body)
+
+    written: list[str] = []
+    writes: Dict[str, int] = {}
+    workers = min(max_workers or MAX_CONCURRENCY, len(bodies))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            key: executor.submit(_put_remote, key, full_key, body)
+            for key, (full_key, body) in bodies.items()
+        }
+        for key, future in futures.items():
+            if future.result():
+                full_key, body = bodies[key]
+                written.append(key)
+                writes[_entry_name(namespace, full_key)] = len(body)
+    _track_writes(namespace, writes)
+    return written
 
 
 def delete_cache(namespace: str, key: str) -> None:
     full_key = _get_full_key(namespace, key)
+    _delete_local(full_key)
+    keys = [full_key]
+    if _reads_legacy(namespace):
+        # Also drop any legacy copy so it doesn't get migrated back on the next read
+        keys.append(_legacy_key(namespace, key))
     try:
-        s3_client.delete_object(Bucket=S3_BUCKET, Key=full_key)
+        s3_client().delete_objects(
+            Bucket=S3_BUCKET,
+            Delete={"Objects": [{"Key": k} for k in keys], "Quiet": True},
+        )
         logger.info(f"Cache deleted for key: {full_key}")
     except Exception as e:
         logger.error(f"Error deleting cache for key {full_key}: {str(e)}")
 
 
 def set_max_size(namespace: str, max_size: int) -> None:
+    """
+    Register the size limit of `namespace`.
+
+    Only records the limit, since modules call this at import time. It is enforced
+    when the namespace's queued writes are next merged into its index, or by an
+    explicit `enforce_size_limit`.
+    """
     MAX_SIZES[namespace] = max_size
-    logger.info(f"Max size for namespace {namespace} set to {max_size}")
-    enforce_size_limit(namespace)
+
+
+def set_remote_only(namespace: str) -> None:
+    """Bypass the local tiers for `namespace`, for values that change in place."""
+    REMOTE_ONLY.add(namespace)
 
 
 def enforce_size_limit(namespace: str) -> None:
     max_size = MAX_SIZES.get(namespace)
     if not max_size:
         return
+    _update_index(namespace, max_size)
+
+
+def _read_index(namespace: str) -> tuple[dict, str | None]:
+    """Return the namespace index and its ETag, rebuilding it if missing or stale."""
+    index_key = _index_key(namespace)
+    index: dict = {}
+    etag = None
+    try:
+        response = s3_client().get_object(Bucket=S3_BUCKET, Key=index_key)
+        etag = response["ETag"]
+        index = json.loads(response["Body"].read())
+    except s3_client().exceptions.NoSuchKey:
+        logger.info(f"No index found for namespace {namespace}")
+    except (ValueError, UnicodeDecodeError):
+        logger.error(f"Corrupt index for namespace {namespace}")
+
+    if (
+        index.get("version") != INDEX_VERSION
+        or time.time() - index.get("rebuilt_at", 0) > INDEX_MAX_AGE_S
+    ):
+        index = _rebuild_index(namespace, index.get("entries", {}))
+    return index, etag
+
 
+def _rebuild_index(namespace: str, known_entries: dict) -> dict:
+    """List the namespace once and rebuild the index, keeping known access times."""
+    logger.info(f"Rebuilding index for namespace {namespace}")
+    entries = {}
+    index_key = _index_key(namespace)
+    paginator = s3_client().get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=S3_BUCKET, Prefix=_namespace_prefix(namespace)
+    ):
+        for obj in page.get("Contents", []):
+            if obj["Key"] == index_key:
+                continue
+            name = _entry_name(namespace, obj["Key"])
+            last_access = int(obj["LastModified"].timestamp())
+            if name in known_entries:
+                last_access = max(last_access, known_entries[name][1])
+            entries[name] = [obj["Size"], last_access]
+    return {
+        "version": INDEX_VERSION,
+        "rebuilt_at": int(time.time()),
+        "entries": entries,
+    }
+
+
+def _write_index(namespace: str, index: dict, etag: str | None) -> bool:
+    """Conditionally write the index. Returns False if someone else changed it first."""
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
     try:
-        # List all objects in the namespace
-        objects = []
-        paginator = s3_client.get_paginator("list_objects_v2")
-        for page in paginator.paginate(
-            Bucket=S3_BUCKET, Prefix=f"{CACHE_PREFIX}{namespace}/"
+        s3_client().put_object(
+            Bucket=S3_BUCKET,
+            Key=_index_key(namespace),
+            Body=json.dumps(index, separators=(",", ":")).encode("utf-8"),
+            ContentType="application/json",
+            **condition,
+        )
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in (
+            "PreconditionFailed",
+            "ConditionalRequestConflict",
         ):
-            if "Contents" in page:
-                objects.extend(page["Contents"])
-
-        # Sort objects by timestamp (oldest first)
-        objects.sort(
-            key=lambda x: int(
-                s3_client.head_object(Bucket=S3_BUCKET, Key=x["Key"])["Metadata"][
-                    "timestamp"
-                ]
-            )
+            return False
+        raise
+
+
+def _delete_entries(namespace: str, names: list[str]) -> None:
+    full_keys = [_namespace_prefix(namespace) + name for name in names]
+    for full_key in full_keys:
+        _delete_local(full_key)
+    # delete_objects takes at most 1000 keys per request
+    for i in range(0, len(full_keys), 1000):
+        s3_client().delete_objects(
+            Bucket=S3_BUCKET,
+            Delete={
+                "Objects": [{"Key": key} for key in full_keys[i : i + 1000]],
+                "Quiet": True,
+            },
         )
+    logger.info(f"Evicted {len(full_keys)} entries from namespace {namespace}")
+    telemetry.count("CacheEvictions", len(full_keys), namespace=namespace)
+
+
+def _requeue(
+    namespace: str, writes: Dict[str, tuple[int, int]], accesses: Dict[str, int]
+) -> None:
+    """Put back writes and accesses an index update failed to merge."""
+    with _pending_lock:
+        pending = _pending_writes.setdefault(namespace, {})
+        for name, write in writes.items():
+            pending.setdefault(name, write)
+        recent = _pending_access.setdefault(namespace, {})
+        for name, last_access in accesses.items():
+            recent[name] = max(recent.get(name, 0), last_access)
+
+
+def _update_index(namespace: str, limit: int) -> None:
+    """
+    Merge queued writes and recent accesses into the namespace index. If the index
+    then holds more than `limit` entries, the least recently used ones are evicted
+    down to `MAX_SIZES[namespace]`.
+    """
+    max_size = MAX_SIZES[namespace]
+    with _pending_lock:
+        writes = _pending_writes.pop(namespace, {})
+        accesses = _pending_access.pop(namespace, {})
+    merged = False
+    try:
+        for _ in range(INDEX_WRITE_ATTEMPTS):
+            index, etag = _read_index(namespace)
+            entries = index["entries"]
+            for name, (size, written_at) in writes.items():
+                entries[name] = [size, written_at]
+            for name, last_access in accesses.items():
+                if name in entries:
+                    entries[name][1] = max(entries[name][1], last_access)
 
-        # Delete oldest objects if the count exceeds the max size
-        objects_to_delete = objects[:-max_size] if len(objects) > max_size else []
-        for obj in objects_to_delete:
-            s3_client.delete_object(Bucket=S3_BUCKET, Key=obj["Key"])
-            logger.info(f"Deleted old cache entry: {obj['Key']}")
+            evicted: list[str] = []
+            if len(entries) > limit:
+                by_age = sorted(entries, key=lambda name: entries[name][1])
+                evicted = by_age[: len(entries) - max_size]
+                for name in evicted:
+                    del entries[name]
 
+            if _write_index(namespace, index, etag):
+                merged = True
+                if evicted:
+                    with telemetry.span("CacheEvictionLatency", namespace=namespace):
+                        _delete_entries(namespace, evicted)
+                return
+        logger.warning(f"Gave up updating contended index for namespace {namespace}")
     except Exception as e:
-        logger.error(f"Error enforcing size limit for namespace {namespace}: {str(e)}")
+        logger.error(f"Error updating index for namespace {namespace}: {str(e)}")
+    finally:
+        if not merged:
+            _requeue(namespace, writes, accesses)
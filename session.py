@@ -1,67 +1,168 @@
+import asyncio
 import os
-import time
-from typing import Any
-
-import litellm  # type: ignore
-import requests  # type: ignore
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable
 
 from aws_lambda_powertools import Logger
 from lite_llms import TextModel
-from litellm import completion  # type: ignore
 from messages import ChatMessage, ChatRole
 from slack_sdk import WebClient
 
+import identity_cache
+import session_store
+import telemetry
+import transcript_store
+from context_packer import ATTACHMENT_BLOCK, block_budget, pack_context
+from digests import Digester
+from enrichment import EnrichmentJob, run_jobs
+from fetcher import MAX_DOWNLOAD_BYTES, download
+from model_router import ModelRouter, describe_stats
 from pdf_utils import extract_text_from_pdf
+from retrieval import focus_history
+from slack_stream import SlackStreamSink
+from url_metadata import get_url_metadata
 from web_reader import scrape_text
 from ytsubs import is_youtube_video, yt_transcript
 
+if TYPE_CHECKING:
+    from slack_sdk.web.async_client import AsyncWebClient
+
 BOT_TOKEN = os.environ.get("SLACK_BOT_TOKEN")
 ERROR_HEADER = "Something went wrong.\nHere's the traceback for the brave of heart:\n"
 HELP_PREAMBLE = "Welcome to SushiBot."
+# Models whose providers take explicit prompt cache breakpoints through litellm
+CACHE_CONTROL_MODELS = ("claude-", "anthropic/")
+MAX_CACHE_BREAKPOINTS = 4
+# Anthropic doesn't cache shorter prefixes, so marking them would be pointless
+MIN_CACHE_PREFIX_TOKENS = 1024
+# Far more than fits in a prompt anyway; the context packer trims what's left
+MAX_TEXT_FILE_BYTES = 4 * 1024 * 1024
 logger = Logger()
 
 ################
 ## Global config
 ################
 
-# Allow litellm to insert empty user msg in claude requests for instance
-litellm.modify_params = True
-
-
-download_cache: dict[str, bytes] = {}
 
-
-def download_file(file_url: str):
-    if file_url in download_cache:
-        return download_cache[file_url]
-    response = requests.get(file_url, headers={"Authorization": f"Bearer {BOT_TOKEN}"})
-    if response.status_code != 200:
-        raise Exception(f"Error downloading file: {response.status_code}")
-    download_cache[file_url] = response.content
-    if len(download_cache) > 20:
-        oldest_url = next(iter(download_cache))
-        del download_cache[oldest_url]
-    return download_cache[file_url]
+def completion(**kwargs) -> Any:
+    """Call `litellm.completion`, importing litellm on first use to keep cold starts short."""
+    import litellm  # type: ignore
+
+    # Allow litellm to insert empty user msg in claude requests for instance
+    litellm.modify_params = True
+    return litellm.completion(**kwargs)
+
+
+async def acompletion(**kwargs) -> Any:
+    """Async counterpart of `completion`, over `litellm.acompletion`."""
+    import litellm  # type: ignore
+
+    litellm.modify_params = True
+    return await litellm.acompletion(**kwargs)
+
+
+# Looks `completion` up on each call, so it can be swapped out after import
+router = ModelRouter(
+    lambda **kwargs: completion(**kwargs), lambda **kwargs: acompletion(**kwargs)
+)
+
+
+def summarize(model: TextModel, messages: list[dict], **kwargs) -> str:
+    # Not routed, since a fallback would send the document to another provider
+    response = completion(model=model.value, messages=messages, **kwargs)
+    return response.choices[0].message.content or ""  # type: ignore
+
+
+# Digests of large attachments, written as they're first seen
+digester = Digester(summarize)
+
+
+def download_file(file_url: str, max_bytes: int = MAX_DOWNLOAD_BYTES) -> BinaryIO:
+    return download(
+        file_url, headers={"Authorization": f"Bearer {BOT_TOKEN}"}, max_bytes=max_bytes
+    )
+
+
+def plan_prompt_cache(
+    model: TextModel, messages: list[dict[str, Any]], prompt_tokens: int
+) -> list[dict[str, Any]]:
+    """
+    Mark cache breakpoints on the stable prefix of `messages` for providers that take
+    them, so it isn't reprocessed every turn. Other providers get `messages` as is.
+
+    The system prompt and the message before the latest one get a breakpoint, which
+    caches the whole conversation so far. Any left over go to the largest attachment
+    blocks in between, so they stay cached even once the conversation outgrows the
+    provider's lookback from the last breakpoint. Only the latest message may depend
+    on the query (see `focus_history`), so every breakpoint is on a stable prefix.
+    """
+    if (
+        not model.value.startswith(CACHE_CONTROL_MODELS)
+        or prompt_tokens < MIN_CACHE_PREFIX_TOKENS
+    ):
+        return messages
+    last = len(messages) - 1
+    breakpoints = {0, last - 1} if last >= 2 else {0}
+    attachments = [
+        i for i in range(1, last - 1) if ATTACHMENT_BLOCK.search(messages[i]["content"])
+    ]
+    attachments.sort(key=lambda i: len(messages[i]["content"]), reverse=True)
+    breakpoints.update(attachments[: MAX_CACHE_BREAKPOINTS - len(breakpoints)])
+
+    planned = []
+    for i, msg in enumerate(messages):
+        if i in breakpoints and isinstance(msg["content"], str):
+            block = {
+                "type": "text",
+                "text": msg["content"],
+                "cache_control": {"type": "ephemeral"},
+            }
+            msg = {**msg, "content": [block]}
+        planned.append(msg)
+    return planned
+
+
+def log_cache_usage(model: TextModel, usage: Any) -> dict[str, int] | None:
+    """Log how much of the prompt was read from or written to the provider's cache."""
+    if usage is None:
+        return None
+    read = getattr(usage, "cache_read_input_tokens", None) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    if not read and details is not None:
+        # OpenAI caches long prompts automatically and reports it here
+        read = getattr(details, "cached_tokens", None) or 0
+    stats = {
+        "prompt_tokens": getattr(usage, "prompt_tokens", None) or 0,
+        "cache_read_tokens": read,
+        "cache_write_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0,
+    }
+    logger.info(f"Prompt cache usage for {model.value}: {stats}")
+    telemetry.count("LlmCacheReadTokens", read, model=model.value)
+    telemetry.count(
+        "LlmCacheWriteTokens", stats["cache_write_tokens"], model=model.value
+    )
+    return stats
 
 
 def check_mimetype(url) -> str:
-    try:
-        response = requests.head(url)
-        return response.headers.get("Content-Type", "unknown")
-    except requests.exceptions.RequestException:
-        return "unknown"
+    return get_url_metadata(url).content_type
 
 
 class ChatSession:
-    def __init__(self, user_id: str, channel_id: str, client: WebClient):
+    def __init__(
+        self, user_id: str, channel_id: str, client: WebClient, lookup: bool = True
+    ):
+        """
+        :param lookup: Look up the sender and load the session settings now. The async
+            pipeline passes False and does both concurrently with its other calls.
+        """
         self.user_id = user_id
         self.channel_id = channel_id
         self.client = client
+        self.user_name = ""
         self.streaming_mode = True
-        # Retrieve the sender's information using the Slack API
-        sender_info = client.users_info(user=user_id)
-        self.user_name = sender_info["user"]["real_name"]
         self.model = TextModel.CLAUDE_35_SONNET
+        self.reset_ts: str | None = None
+        self.settings: session_store.SessionSettings | None = None
         self.system_instr = (
             "You are a helpful assistant called SushiBot running as a Slack App. Keep the "
             "conversation natural and flowing, don't respond with robotic or closing statements like "
@@ -74,21 +175,79 @@ class ChatSession:
             "Here goes the chat history so far and the latest activity..."
         )
         self.say = None
+        if lookup:
+            # Retrieve the sender's information using the Slack API
+            self.user_name = identity_cache.get_user_real_name(client, user_id)
+            self.apply_settings(session_store.load(user_id, channel_id))
+
+    def apply_settings(self, settings: session_store.SessionSettings | None) -> None:
+        # Sessions that predate settings records rebuild them by replaying commands
+        self.settings = settings
+        if settings:
+            if settings.model in TextModel._value2member_map_:
+                self.model = TextModel(settings.model)
+            self.streaming_mode = settings.streaming_mode
+            self.reset_ts = settings.reset_ts
 
     def fetch_conversation_history(self) -> tuple[list[ChatMessage], list[str]]:
+        stored = transcript_store.load(self.channel_id)
         try:
-            conversation_history = self.client.conversations_history(
-                channel=self.channel_id, limit=50
-            )
+            with telemetry.span("HistoryFetchLatency"):
+                conversation_history = self.client.conversations_history(
+                    **self.history_request(stored)
+                )
         except Exception as e:
             logger.error(f"Error fetching conversation history: {str(e)}")
             raise e
+        with telemetry.span("HistoryBuildLatency"):
+            return self.build_history(conversation_history, stored)
+
+    def history_request(
+        self, stored: transcript_store.Transcript | None
+    ) -> dict[str, Any]:
+        """Arguments of the `conversations_history` call this turn needs."""
+        if stored and stored.newest_ts:
+            # Only fetch what was posted after the stored transcript
+            return {"channel": self.channel_id, "limit": 50, "oldest": stored.newest_ts}
+        if self.reset_ts:
+            # Nothing before the last reset is part of the session
+            return {
+                "channel": self.channel_id,
+                "limit": 50,
+                "oldest": self.reset_ts,
+                "inclusive": True,
+            }
+        return {"channel": self.channel_id, "limit": 50}
+
+    def build_history(
+        self,
+        conversation_history: Any,
+        stored: transcript_store.Transcript | None,
+        skip_ts: str | None = None,
+    ) -> tuple[list[ChatMessage], list[str]]:
+        """
+        Turn a `conversations_history` response into the chat history and commands of
+        the session, enriching links and files and updating the stored transcript.
+
+        :param skip_ts: A message of this turn's own that the fetch may have caught,
+            like a placeholder posted alongside it. It's left for the next turn.
+        """
+        if stored and stored.newest_ts and conversation_history.get("has_more"):
+            stored = None
         try:
             messages = conversation_history["messages"]
 
-            history: list[ChatMessage] = []
-            commands: list[str] = []
+            # First pass: collect text and enrichment jobs, newest message first
+            history: list[tuple[str, ChatMessage | EnrichmentJob]] = []
+            commands: list[tuple[str, str]] = []
+            covered_ts: list[str] = []
+            deferred_pops = 0
+            reset = False
             for message in messages:
+                ts = message.get("ts", "0")
+                if ts == skip_ts:
+                    continue
+                covered_ts.append(ts)
                 text = message.get("text")
                 sent_by_user = message.get("user") == self.user_id
                 if text:
@@ -96,20 +255,30 @@ class ChatSession:
                         # Exclude command's response from chat history
                         if history:
                             history.pop()
-                        commands.append(text)
+                        else:
+                            deferred_pops += 1
+                        commands.append((ts, text))
                         if text == "\\reset":
+                            reset = True
                             break
                         continue
                     elif text.startswith(ERROR_HEADER):
-                        history.append(ChatMessage.from_assistant("<Unknown Error />"))
+                        history.append(
+                            (ts, ChatMessage.from_assistant("<Unknown Error />"))
+                        )
                         continue
                     elif text.startswith(HELP_PREAMBLE):
                         continue
                     else:
                         history.append(
-                            ChatMessage.from_user(text)
-                            if sent_by_user
-                            else ChatMessage.from_assistant(text)
+                            (
+                                ts,
+                                (
+                                    ChatMessage.from_user(text)
+                                    if sent_by_user
+                                    else ChatMessage.from_assistant(text)
+                                ),
+                            )
                         )
                     # Append the content of URLs to this text
                     if sent_by_user:
@@ -122,92 +291,124 @@ class ChatSession:
                                 for unit in inner_elements:
                                     if unit.get("type") == "link":
                                         url = unit.get("url")
-                                        if not url:
-                                            continue
-
-                                        mimetype = check_mimetype(url)
-                                        logger.info(
-                                            f"Found link [{url}] of type [{mimetype}]."
-                                        )
-                                        if mimetype.startswith(
-                                            "image/"
-                                        ) or mimetype in [
-                                            "text/plain",
-                                            "application/pdf",
-                                        ]:
-                                            message.setdefault("files", []).append(
-                                                {
-                                                    "name": url,
-                                                    "url_private": url,
-                                                    "mimetype": mimetype,
-                                                }
-                                            )
-                                            continue
-
-                                        if is_youtube_video(url):
-                                            logger.debug(
-                                                f"Fetching youtube transcript for [{url}]."
-                                            )
-                                            content = yt_transcript(url)
-                                            tag = "YoutubeTranscript"
-                                        else:
-                                            logger.debug(f"Reading text from [{url}].")
-                                            content = scrape_text(url)
-                                            tag = "ScrapedTextFromURL"
-                                        if content:
-                                            history.append(
-                                                ChatMessage.from_user(
-                                                    f"<{tag} url={url}>\n{content}\n</{tag}>"
-                                                )
-                                            )
+                                        if url:
+                                            history.append((ts, self.link_job(url)))
 
                 files = message.get("files", [])
                 for file in files:
                     logger.debug(f"Files:\n{file}")
-                    msg = None
-                    mimetype = file.get("mimetype", "")
-                    logger.info(f"Found file [{file['name']}] of type [{mimetype}].")
-                    if mimetype.startswith("image/"):
-                        msg = f"<Image name:{file['name']}/>"
-                        file_url = file["url_private"]
-                        logger.error("Found image attachment.")
-                    elif mimetype == "text/plain":
-                        file_url = file["url_private"]
-                        content = download_file(file_url)
-                        msg = f"<File mimetype={file['mimetype']}>\n{content}\n</File>"
-                    elif mimetype == "application/pdf":
-                        file_url = file["url_private"]
-                        msg = f"<File mimetype={file['mimetype']}>\n{extract_text_from_pdf(file_url)}\n</File>"
-                    else:
-                        msg = f"<File name={file['name']}/>"
-                    if msg:
-                        history.append(
-                            ChatMessage.from_user(msg)
-                            if sent_by_user
-                            else ChatMessage.from_assistant(msg)
-                        )
-
-            history = list(reversed(history))
+                    history.append((ts, self.file_job(file, sent_by_user)))
+
+            transcript = transcript_store.Transcript()
+            if stored and not reset:
+                # Commands that ended the stored transcript drop the responses
+                # that have since been posted
+                while stored.deferred_pops and history:
+                    history.pop()
+                    stored.deferred_pops -= 1
+                deferred_pops += stored.deferred_pops
+                transcript = stored
+
+            # Second pass: run the fetches concurrently and splice results in place
+            jobs = [item for _, item in history if isinstance(item, EnrichmentJob)]
+            enriched = iter(run_jobs(jobs))
+            resolved: list[tuple[str, ChatMessage]] = []
+            for ts, item in history:
+                msg = next(enriched) if isinstance(item, EnrichmentJob) else item
+                if msg:
+                    resolved.append((ts, msg))
+
+            transcript.message_ts += reversed(covered_ts)
+            transcript.entries += reversed(resolved)
+            transcript.commands += reversed(commands)
+            transcript.deferred_pops = deferred_pops
+            transcript.trim()
+            # Placeholders for failed fetches shouldn't outlive this turn
+            if not any(job.failed for job in jobs):
+                transcript_store.save(self.channel_id, transcript)
+
+            messages = [
+                ChatMessage(m.content, m.role, m.name) for _, m in transcript.entries
+            ]
             # Ensure first message is from user
-            if history and not history[0].is_from(ChatRole.USER):
-                history = [ChatMessage.from_user("...")] + history
+            if messages and not messages[0].is_from(ChatRole.USER):
+                messages = [ChatMessage.from_user("...")] + messages
 
             # Merge consecutive user messages into one
             merged_messages: list[ChatMessage] = []
             prev_role = None
-            for chatmsg in history:
+            for chatmsg in messages:
                 if chatmsg.is_from(prev_role):  # type: ignore
                     merged_messages[-1].content += "\n" + chatmsg.content
                 else:
                     merged_messages.append(chatmsg)
                     prev_role = chatmsg.role
             logger.debug(f"<history>\n{merged_messages}</history>")
-            return (merged_messages, list(reversed(commands)))
+            return (merged_messages, [text for _, text in transcript.commands])
 
         except Exception as e:
             logger.error(f"Error processing conversation: {str(e)}")
             raise e
 
+    def link_job(self, url: str) -> EnrichmentJob:
+        def run() -> ChatMessage | None:
+            mimetype = check_mimetype(url)
+            logger.info(f"Found link [{url}] of type [{mimetype}].")
+            if mimetype.startswith("image/") or mimetype in [
+                "text/plain",
+                "application/pdf",
+            ]:
+                file = {"name": url, "url_private": url, "mimetype": mimetype}
+                return self.file_job(file, sent_by_user=True).run()
+
+            if is_youtube_video(url):
+                logger.debug(f"Fetching youtube transcript for [{url}].")
+                content = yt_transcript(url, block_budget(self.model))
+                tag = "YoutubeTranscript"
+            else:
+                logger.debug(f"Reading text from [{url}].")
+                content = scrape_text(url)
+                tag = "ScrapedTextFromURL"
+            if content:
+                return ChatMessage.from_user(f"<{tag} url={url}>\n{content}\n</{tag}>")
+            return None
+
+        return EnrichmentJob(
+            name=url,
+            run=run,
+            fallback=ChatMessage.from_user(f"<File name={url}/>"),
+            kind="link",
+        )
+
+    def file_job(self, file: dict, sent_by_user: bool) -> EnrichmentJob:
+        as_message: Callable[[str], ChatMessage] = ChatMessage.from_assistant
+        if sent_by_user:
+            as_message = ChatMessage.from_user
+
+        def run() -> ChatMessage | None:
+            mimetype = file.get("mimetype", "")
+            logger.info(f"Found file [{file['name']}] of type [{mimetype}].")
+            if mimetype.startswith("image/"):
+                logger.error("Found image attachment.")
+                msg = f"<Image name:{file['name']}/>"
+            elif mimetype == "text/plain":
+                with download_file(file["url_private"], MAX_TEXT_FILE_BYTES) as f:
+                    content = f.read().decode("utf-8", "replace")
+                msg = f"<File mimetype={mimetype}>\n{content}\n</File>"
+            elif mimetype == "application/pdf":
+                content = extract_text_from_pdf(file["url_private"])
+                msg = f"<File mimetype={mimetype}>\n{content}\n</File>"
+            else:
+                msg = f"<File name={file['name']}/>"
+            return as_message(msg)
+
+        return EnrichmentJob(
+            name=file["name"],
+            run=run,
+            fallback=as_message(f"<File name={file['name']}/>"),
+            kind="file",
+        )
+
     def is_command(self, text):
         if not isinstance(text, str):
             return False
@@ -270,6 +471,8 @@ class ChatSession:
         elif cmd == "\\nostream":
             self.streaming_mode = False
             say(text="Streaming mode disabled.")
+        elif cmd == "\\stats":
+            say(text=describe_stats(router.stats()))
         elif cmd == "\\help":
             say(
                 f"""
@@ -284,6 +487,7 @@ class ChatSession:
 - \\gemini: Use Gemini 1.5 Pro for future messages. Preserves the session so far.\n
 - \\flash: Use Gemini 1.5 Flash for future messages. Preserves the session so far.\n
 - \\stream: Toggle streaming mode. In streaming mode, the bot will send you a message every time it generates a new token.\n
+- \\stats: Show how fast and reliable each model has been lately.\n
                 """
             )
         else:
@@ -291,91 +495,222 @@ class ChatSession:
             return False
         return True
 
-    def process_direct_message(self, text, say, logger):
-        self.say = say
+    def save_settings(self) -> None:
+        settings = session_store.SessionSettings(
+            model=self.model.value,
+            streaming_mode=self.streaming_mode,
+            reset_ts=self.reset_ts,
+        )
+        if settings != self.settings:
+            session_store.save(self.user_id, self.channel_id, settings)
+            self.settings = settings
 
-        messages, commands = self.fetch_conversation_history()
+    def greeting(self, text, messages, commands) -> str | None:
+        """The welcome message for a session's first turn, if this is one."""
         if len(messages) < 2 and len(commands) == 0 and not self.is_command(text):
-            say(
+            return (
                 HELP_PREAMBLE
                 + ' At any time, enter "\\help" for a list of commands. Response to your first message will follow now.'
             )
-
-        # Re-run previous commands in session
-        for cmd in commands[:-1]:
-            self.process_command(cmd)
-
-        # Run the latest command, responding if it's the current message
+        return None
+
+    def prepare_turn(self, text, commands, say, ts=None) -> bool:
+        """
+        Bring the settings up to date with the commands in history. Returns True if
+        `text` was a command, which is the whole turn.
+        """
+        if not self.settings:
+            # Re-run previous commands in session
+            for cmd in commands[:-1]:
+                self.process_command(cmd)
+            if commands and not self.is_command(text):
+                self.process_command(commands[-1])
+            self.save_settings()
+
+        # Run the latest command, responding since it's the current message
         if self.is_command(text):
             if self.process_command(text, say):
-                return  # Don't return if command processing failed. Let's process it like a text
-        elif commands:
-            self.process_command(commands[-1])
-
-        messages = (
-            [ChatMessage.from_system(self.system_instr)] + messages
+                if text.strip() == "\\reset" and ts:
+                    self.reset_ts = ts
+                self.save_settings()
+                return True  # Don't return if command processing failed. Let's process it like a text
+        return False
+
+    def build_prompt(
+        self, text: str, messages: list[ChatMessage]
+    ) -> tuple[list[dict], int]:
+        """The messages to send for this turn, and their size in tokens."""
+        system = (
+            ChatMessage.from_system(self.system_instr)
             if not self.model.value.startswith("o1")
-            else [ChatMessage.from_user(self.system_instr)] + messages
+            else ChatMessage.from_user(self.system_instr)
+        )
+        # Large attachments bring their digest and the sections relevant to this
+        # message, which go with the message itself so the prefix stays cacheable
+        messages = focus_history(
+            messages, text, lambda body: digester.lookup(body, self.model)
         )
-        messages = [msg.to_openai_format() for msg in messages]
-        logger.debug(messages)
+        packed = pack_context(system, messages, self.model)
+        prompt = [msg.to_openai_format() for msg in packed.messages]
+        prompt = plan_prompt_cache(self.model, prompt, packed.prompt_tokens)
+        return prompt, packed.prompt_tokens
+
+    def streams_reply(self) -> bool:
+        return self.streaming_mode and not self.model.value.startswith("o1")
+
+    def process_direct_message(self, text, say, logger, ts=None):
+        self.say = say
+
+        messages, commands = self.fetch_conversation_history()
+        greeting = self.greeting(text, messages, commands)
+        if greeting:
+            say(greeting)
+        if self.prepare_turn(text, commands, say, ts):
+            return
+        prompt, prompt_tokens = self.build_prompt(text, messages)
+        logger.debug(prompt)
 
         # Process the user's message using the selected model and conversation history
-        if not self.streaming_mode or self.model.value.startswith("o1"):
-            response = completion(model=self.model.value, messages=messages)
+        if not self.streams_reply():
+            model, response = router.complete(self.model, prompt, prompt_tokens)
+            log_cache_usage(model, getattr(response, "usage", None))
             say(text=response.choices[0].message.content)  # type: ignore
             return
 
-        response = completion(model=self.model.value, messages=messages, stream=True)
+        response = router.stream(self.model, prompt, prompt_tokens)
         initial_message = self.client.chat_postMessage(
             channel=self.channel_id, text=f"[[ {self.model.value} ]] Thinking ..."
         )["ts"]
-        last_update_time = time.time()
-        update_interval = 1  # Start with 1 second interval
-        start_time = time.time()
-        full_response = ""
-        current_message = ""
-        message_ts = initial_message
-
-        for part in response:
-            last_chunk = part.choices[0].delta.content or ""  # type: ignore
-            full_response += last_chunk
-            current_message += last_chunk
-            current_time = time.time()
-
-            # Check if it's time to send an update or start a new message
-            if (
-                current_time - last_update_time >= update_interval
-                or len((current_message).split()) > 320
-                or len((current_message)) > 2400
-            ):
-                # Update existing message
-                self.client.chat_update(
+        sink = SlackStreamSink(
+            self.client,
+            self.channel_id,
+            initial_message,
+            f"{self.model.value} thinking",
+        )
+        usage = None
+        try:
+            for part in response:
+                # Usage, where the provider streams it, comes with the last chunk
+                usage = getattr(part, "usage", None) or usage
+                if response.model is not self.model:
+                    sink.label = f"{response.model.value} thinking"
+                sink.write(part.choices[0].delta.content or "")  # type: ignore
+        finally:
+            # Final update to remove the suffix
+            sink.close()
+        log_cache_usage(response.model, usage)
+        # A turn that started mid-stream may have stored a partial response
+        transcript_store.invalidate_if_covers(self.channel_id, initial_message)
+
+    async def process_direct_message_async(
+        self, text, say, logger, async_client: "AsyncWebClient", ts=None
+    ):
+        """
+        `process_direct_message`, with its independent steps overlapped.
+
+        Slack calls go through `async_client` and the completion through
+        `litellm.acompletion`. Blocking work (S3, enrichment, context packing) runs
+        in threads, and streamed tokens are handed to a `SlackStreamSink`, whose
+        sender thread posts the updates while the loop keeps reading the stream.
+        """
+        self.say = say
+        # Nothing waits on the sender's name, so its lookup runs alongside the rest
+        user_name = asyncio.create_task(
+            identity_cache.aget_user_real_name(async_client, self.user_id)
+        )
+        settings, stored = await asyncio.gather(
+            asyncio.to_thread(session_store.load, self.user_id, self.channel_id),
+            asyncio.to_thread(transcript_store.load, self.channel_id),
+        )
+        self.apply_settings(settings)
+
+        history_call = telemetry.timed(
+            "HistoryFetchLatency",
+            async_client.conversations_history(**self.history_request(stored)),
+        )
+        initial_message = None
+        # A turn that will stream its reply can post the placeholder right away.
+        # Sessions without settings may still switch models by replaying commands.
+        if settings and self.streams_reply() and not self.is_command(text):
+            conversation_history, posted = await asyncio.gather(
+                history_call,
+                async_client.chat_postMessage(
+                    channel=self.channel_id,
+                    text=f"[[ {self.model.value} ]] Thinking ...",
+                ),
+            )
+            initial_message = posted["ts"]
+        else:
+            conversation_history = await history_call
+        try:
+            messages, commands = await telemetry.timed(
+                "HistoryBuildLatency",
+                asyncio.to_thread(
+                    self.build_history, conversation_history, stored, initial_message
+                ),
+            )
+            self.user_name = await user_name
+            greeting = self.greeting(text, messages, commands)
+            if greeting and initial_message:
+                # The placeholder went up before history showed this was a new session
+                await async_client.chat_update(
+                    channel=self.channel_id, ts=initial_message, text=greeting
+                )
+                initial_message = None
+            elif greeting:
+                await async_client.chat_postMessage(
+                    channel=self.channel_id, text=greeting
+                )
+            if await asyncio.to_thread(self.prepare_turn, text, commands, say, ts):
+                return
+            prompt, prompt_tokens = await asyncio.to_thread(
+                self.build_prompt, text, messages
+            )
+            logger.debug(prompt)
+
+            if not self.streams_reply():
+                model, response = await router.acomplete(
+                    self.model, prompt, prompt_tokens
+                )
+                log_cache_usage(model, getattr(response, "usage", None))
+                await async_client.chat_postMessage(
+                    channel=self.channel_id, text=response.choices[0].message.content  # type: ignore
+                )
+                return
+
+            response = router.astream(self.model, prompt, prompt_tokens)
+            if not initial_message:
+                posted = await async_client.chat_postMessage(
                     channel=self.channel_id,
-                    ts=message_ts,
-                    text=f"{current_message} ... [[ {self.model.value} thinking ]] ...",
+                    text=f"[[ {self.model.value} ]] Thinking ...",
                 )
-                if len(current_message.split()) > 320 or len(current_message) > 2400:
-                    self.client.chat_update(
-                        channel=self.channel_id,
-                        ts=message_ts,
-                        text=current_message,
+                initial_message = posted["ts"]
+        except Exception:
+            if initial_message:
+                # The error is reported in its own message, so the placeholder goes
+                try:
+                    await async_client.chat_delete(
+                        channel=self.channel_id, ts=initial_message
                     )
-                    # Start a new message with just the new content
-                    message_ts = self.client.chat_postMessage(
-                        channel=self.channel_id,
-                        text=f"... [[ {self.model.value} thinking ]] ...",
-                    )["ts"]
-                    current_message = ""
-                last_update_time = current_time
-
-            # Adjust the update interval if the process takes more than 30 seconds
-            if current_time - start_time > 30:
-                update_interval = 2
-            if current_time - start_time > 90:
-                update_interval = 2.5
-
-        # Final update to remove the suffix
-        self.client.chat_update(
-            channel=self.channel_id, ts=message_ts, text=current_message
+                except Exception as e:
+                    logger.error(f"Failed to remove the placeholder: {str(e)}")
+            raise
+        sink = SlackStreamSink(
+            self.client,
+            self.channel_id,
+            initial_message,
+            f"{self.model.value} thinking",
+        )
+        usage = None
+        try:
+            async for part in response:
+                usage = getattr(part, "usage", None) or usage
+                if response.model is not self.model:
+                    sink.label = f"{response.model.value} thinking"
+                sink.write(part.choices[0].delta.content or "")  # type: ignore
+        finally:
+            await asyncio.to_thread(sink.close)
+        log_cache_usage(response.model, usage)
+        await asyncio.to_thread(
+            transcript_store.invalidate_if_covers, self.channel_id, initial_message
         )
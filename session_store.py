@@ -0,0 +1,46 @@
+import json
+import logging
+from dataclasses import asdict, dataclass
+
+import s3_cache
+
+logger = logging.getLogger(__name__)
+CACHE_NAMESPACE = "session_settings"
+s3_cache.set_max_size(CACHE_NAMESPACE, 1000)
+s3_cache.set_remote_only(CACHE_NAMESPACE)
+
+
+@dataclass
+class SessionSettings:
+    """
+    The state that commands leave behind in a session.
+
+    :param model: Value of the selected `TextModel`.
+    :param streaming_mode: Whether responses are streamed.
+    :param reset_ts: Slack ts of the latest `\\reset`, if any. History starts there.
+    """
+
+    model: str
+    streaming_mode: bool
+    reset_ts: str | None = None
+
+
+def _key(user_id: str, channel_id: str) -> str:
+    return f"{user_id}:{channel_id}"
+
+
+def load(user_id: str, channel_id: str) -> SessionSettings | None:
+    data = s3_cache.get_cache(CACHE_NAMESPACE, _key(user_id, channel_id))
+    if not data:
+        return None
+    try:
+        return SessionSettings(**json.loads(data))
+    except (ValueError, TypeError) as e:
+        logger.error(f"Discarding unreadable settings for [{user_id}]: {e}")
+        return None
+
+
+def save(user_id: str, channel_id: str, settings: SessionSettings) -> None:
+    s3_cache.set_cache(
+        CACHE_NAMESPACE, _key(user_id, channel_id), json.dumps(asdict(settings))
+    )
@@ -0,0 +1,211 @@
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+from aws_lambda_powertools import Logger
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+import telemetry
+
+logger = Logger()
+
+# chat.update is a Tier 3 method and chat.postMessage allows about one message per
+# second per channel, so one call a second is the sustained rate we can rely on.
+MIN_UPDATE_INTERVAL_S = float(os.environ.get("SLACK_UPDATE_INTERVAL_S", 1.0))
+MAX_MESSAGE_WORDS = 320
+MAX_MESSAGE_CHARS = 2400
+WORD = re.compile(r"\S+")
+FENCE = "```"
+
+
+@dataclass
+class _Segment:
+    """One Slack message of a streamed response."""
+
+    text: str = ""
+    ts: str | None = None
+    sent: str | None = None
+    final: bool = False
+
+
+def split_point(text: str, limit: int) -> tuple[int, bool]:
+    """
+    Pick where to cut `text` so the head stays within `limit` characters.
+
+    Prefers the last paragraph break, then the last line break, outside code fences,
+    and only then the last whitespace. Returns the offset and whether a code fence
+    is open there.
+    """
+    fence_open = False
+    paragraph = line_break = -1
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        end = offset + len(line)
+        if end > limit:
+            break
+        if line.lstrip().startswith(FENCE):
+            fence_open = not fence_open
+        if not fence_open and line.endswith("\n"):
+            line_break = end
+            if not line.strip():
+                paragraph = end
+        offset = end
+    if paragraph > limit // 2:
+        return paragraph, False
+    if line_break > 0:
+        return line_break, False
+
+    cut = max(text.rfind(" ", 0, limit), text.rfind("\n", 0, limit))
+    cut = cut + 1 if cut > 0 else limit
+    return cut, text[:cut].count(FENCE) % 2 == 1
+
+
+class SlackStreamSink:
+    """
+    Streams LLM output into one or more Slack messages.
+
+    `write` only appends to in-memory buffers, so reading tokens never waits on
+    Slack. A background sender posts the latest text of each message, skipping any
+    intermediate states that were overtaken while it waited, and paces itself by
+    Slack's rate limits and `Retry-After`. Messages are split at paragraph or line
+    breaks outside code fences once they grow past the word or character limit.
+    """
+
+    def __init__(
+        self,
+        client: WebClient,
+        channel_id: str,
+        first_ts: str,
+        label: str,
+        min_interval: float = MIN_UPDATE_INTERVAL_S,
+        max_words: int = MAX_MESSAGE_WORDS,
+        max_chars: int = MAX_MESSAGE_CHARS,
+    ):
+        self.client = client
+        self.channel_id = channel_id
+        self.label = label
+        self.min_interval = min_interval
+        self.max_words = max_words
+        self.max_chars = max_chars
+        self.segments = [_Segment(ts=first_ts)]
+        self.update_count = 0
+        self._words = 0
+        self._in_word = False
+        self._closed = False
+        self._next_call_at = 0.0
+        self._cond = threading.Condition()
+        self._sender = threading.Thread(target=self._run, daemon=True)
+        self._sender.start()
+
+    def _count_words(self, text: str) -> int:
+        """Words in `text` that don't continue the last word already counted."""
+        words = len(WORD.findall(text))
+        if words and self._in_word and not text[0].isspace():
+            words -= 1
+        if text:
+            self._in_word = not text[-1].isspace()
+        return words
+
+    def write(self, chunk: str) -> None:
+        if not chunk:
+            return
+        with self._cond:
+            segment = self.segments[-1]
+            segment.text += chunk
+            self._words += self._count_words(chunk)
+            while len(segment.text) > self.max_chars or self._words > self.max_words:
+                segment = self._split(segment)
+            self._cond.notify()
+
+    def _split(self, segment: _Segment) -> _Segment:
+        cut, in_fence = split_point(
+            segment.text, min(len(segment.text), self.max_chars)
+        )
+        head, tail = segment.text[:cut], segment.text[cut:]
+        if in_fence:
+            head, tail = head + "\n" + FENCE, FENCE + "\n" + tail
+        segment.text = head
+        segment.final = True
+        following = _Segment(text=tail)
+        self.segments.append(following)
+        self._in_word = False
+        self._words = self._count_words(tail)
+        return following
+
+    def close(self) -> None:
+        """Flush the final text of every message and stop the sender."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._sender.join()
+
+    def _next_job(self) -> tuple[_Segment, str] | None:
+        for segment in self.segments:
+            if segment.ts == "":
+                continue  # Deleted or failed to post
+            done = segment.final or self._closed
+            text = (
+                segment.text if done else f"{segment.text} ... [[ {self.label} ]] ..."
+            )
+            if segment.ts is None or segment.sent != text:
+                return segment, text
+        return None
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while self._next_job() is None and not self._closed:
+                    self._cond.wait()
+            # Wait out the rate limit first, so the text sent is the latest there is
+            delay = self._next_call_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self._cond:
+                job = self._next_job()
+            if job is None:
+                return
+            self._send(*job)
+
+    def _send(self, segment: _Segment, text: str) -> None:
+        start = time.monotonic()
+        self._next_call_at = start + self.min_interval
+        try:
+            with telemetry.span("SlackUpdateLatency"):
+                if not text.strip():
+                    # Slack rejects empty messages; drop a trailing one without text
+                    if segment.ts:
+                        self.client.chat_delete(channel=self.channel_id, ts=segment.ts)
+                    segment.ts = ""
+                elif segment.ts is None:
+                    segment.ts = self.client.chat_postMessage(
+                        channel=self.channel_id, text=text
+                    )["ts"]
+                else:
+                    self.client.chat_update(
+                        channel=self.channel_id, ts=segment.ts, text=text
+                    )
+            self.update_count += 1
+            telemetry.count("SlackUpdates")
+            segment.sent = text
+        except SlackApiError as e:
+            if e.response.status_code == 429:
+                retry_after = float(e.response.headers.get("Retry-After", 1))
+                logger.warning(f"Rate limited by Slack, retrying in {retry_after}s.")
+                telemetry.count("SlackRateLimited")
+                self._next_call_at = time.monotonic() + retry_after
+                return
+            self._give_up(segment, text, e)
+        except Exception as e:
+            # Network errors and the like; keep streaming so the final flush happens
+            self._give_up(segment, text, e)
+
+    def _give_up(self, segment: _Segment, text: str, error: Exception) -> None:
+        logger.error(f"Failed to update streamed message: {str(error)}")
+        telemetry.count("SlackUpdateErrors")
+        if segment.ts is None:
+            segment.ts = ""
+        # Give up on this state; the next write will try again with newer text
+        segment.sent = text
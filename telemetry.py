@@ -0,0 +1,165 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Awaitable, Iterator, TypeVar
+
+from aws_lambda_powertools import Logger, Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+
+logger = Logger()
+metrics = Metrics(namespace="Powertools")
+T = TypeVar("T")
+
+# Measurements wait here until the handler flushes them. Bounded, since nothing
+# flushes when the app runs as a server rather than on Lambda.
+MAX_PENDING = 10_000
+# CloudWatch takes at most 100 values of one metric per EMF document
+MAX_VALUES = 100
+MILLISECONDS = MetricUnit.Milliseconds.value
+COUNT = MetricUnit.Count.value
+
+
+@dataclass(frozen=True)
+class Measurement:
+    """
+    :param dimensions: Sorted (name, value) pairs. Keep values low-cardinality, like
+        a cache namespace or model name, never a key or URL.
+    """
+
+    name: str
+    value: float
+    unit: str
+    dimensions: tuple[tuple[str, str], ...] = ()
+
+    def label(self) -> str:
+        if not self.dimensions:
+            return self.name
+        dims = ",".join(f"{k}={v}" for k, v in self.dimensions)
+        return f"{self.name}[{dims}]"
+
+
+class MemorySink:
+    """Keeps every measurement recorded while it's attached, for tests and benchmarks."""
+
+    def __init__(self):
+        self.measurements: list[Measurement] = []
+        self._lock = threading.Lock()
+
+    def emit(self, measurement: Measurement) -> None:
+        with self._lock:
+            self.measurements.append(measurement)
+
+    def values(self, name: str, **dimensions: str) -> list[float]:
+        """Values of `name` whose dimensions include `dimensions`."""
+        wanted = set(dimensions.items())
+        with self._lock:
+            return [
+                m.value
+                for m in self.measurements
+                if m.name == name and wanted <= set(m.dimensions)
+            ]
+
+    def total(self, name: str, **dimensions: str) -> float:
+        return sum(self.values(name, **dimensions))
+
+
+_pending: deque[Measurement] = deque(maxlen=MAX_PENDING)
+_sinks: list[MemorySink] = []
+_lock = threading.Lock()
+
+
+def record(name: str, value: float, unit: str = MILLISECONDS, **dimensions: str):
+    measurement = Measurement(name, value, unit, tuple(sorted(dimensions.items())))
+    with _lock:
+        _pending.append(measurement)
+        sinks = list(_sinks)
+    for sink in sinks:
+        sink.emit(measurement)
+
+
+def count(name: str, value: float = 1, **dimensions: str) -> None:
+    record(name, value, COUNT, **dimensions)
+
+
+@contextmanager
+def span(name: str, **dimensions: str) -> Iterator[None]:
+    """Record how long the block takes, in milliseconds, whether or not it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, (time.perf_counter() - start) * 1000, MILLISECONDS, **dimensions)
+
+
+async def timed(name: str, awaitable: Awaitable[T], **dimensions: str) -> T:
+    """`span` around one awaitable, so it can be timed inside `asyncio.gather`."""
+    with span(name, **dimensions):
+        return await awaitable
+
+
+@contextmanager
+def capture() -> Iterator[MemorySink]:
+    """Attach a `MemorySink` for the duration of the block."""
+    sink = MemorySink()
+    with _lock:
+        _sinks.append(sink)
+    try:
+        yield sink
+    finally:
+        with _lock:
+            _sinks.remove(sink)
+
+
+def flush() -> dict[str, dict[str, float]]:
+    """
+    Publish the measurements recorded since the last flush, and return their summary.
+
+    Measurements without dimensions go on the shared `metrics`, which
+    `log_metrics` publishes when the handler returns. Each set of dimensions is
+    printed as its own EMF document right away. The summary is also logged, so
+    the same numbers are searchable as structured log fields.
+    """
+    with _lock:
+        measurements = list(_pending)
+        _pending.clear()
+    if not measurements:
+        return {}
+
+    groups: dict[tuple, dict[str, dict[str, Any]]] = {}
+    summary: dict[str, dict[str, float]] = {}
+    for m in measurements:
+        group = groups.setdefault(m.dimensions, {})
+        metric = group.setdefault(m.name, {"Unit": m.unit, "Value": []})
+        if m.unit == COUNT and metric["Value"]:
+            metric["Value"][0] += m.value
+        elif len(metric["Value"]) < MAX_VALUES:
+            metric["Value"].append(m.value)
+
+        stats = summary.setdefault(m.label(), {"count": 0, "sum": 0.0, "max": 0.0})
+        stats["count"] += 1
+        stats["sum"] += m.value
+        stats["max"] = max(stats["max"], m.value)
+
+    try:
+        for dimensions, group in groups.items():
+            if not dimensions:
+                for name, metric in group.items():
+                    for value in metric["Value"]:
+                        metrics.add_metric(name=name, unit=metric["Unit"], value=value)
+                continue
+            document = metrics.serialize_metric_set(
+                metrics={
+                    name: {**metric, "StorageResolution": 60}
+                    for name, metric in group.items()
+                },
+                dimensions=dict(dimensions),
+                metadata={},
+            )
+            print(json.dumps(document, separators=(",", ":")))
+    except Exception as e:
+        logger.error(f"Failed to publish metrics: {str(e)}")
+    logger.info("Invocation telemetry", extra={"telemetry": summary})
+    return summary
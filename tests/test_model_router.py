@@ -0,0 +1,236 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import model_router
+from context_packer import prompt_budget
+from lite_llms import TextModel
+from model_router import ModelRouter
+
+PRIMARY = TextModel.CLAUDE_35_SONNET
+FALLBACK = TextModel.GPT_4O
+HEDGE_AFTER_S = 0.2
+MESSAGES = [
+    {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "hi", "cache_control": {"type": "ephemeral"}}
+        ],
+    }
+]
+
+
+def chunk(text: str) -> SimpleNamespace:
+    delta = SimpleNamespace(content=text)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+
+
+def reply(text: str) -> SimpleNamespace:
+    message = SimpleNamespace(content=text)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+class FakeProvider:
+    """
+    Answers like `litellm.completion` and `acompletion`, per model: after `delay`
+    seconds, or by raising `error`.
+    """
+
+    def __init__(self, **behaviour: dict):
+        self.behaviour = {TextModel(model): b for model, b in behaviour.items()}
+        self.calls: list[tuple[TextModel, float, list]] = []
+        self.closed: set[TextModel] = set()
+        self._lock = threading.Lock()
+
+    def _start(self, model: str, messages: list) -> dict:
+        with self._lock:
+            self.calls.append((TextModel(model), time.monotonic(), messages))
+        return self.behaviour[TextModel(model)]
+
+    def called(self) -> list[TextModel]:
+        return [model for model, _, _ in self.calls]
+
+    def completion(self, model: str, messages: list, stream: bool = False, **kwargs):
+        behaviour = self._start(model, messages)
+        if not stream:
+            time.sleep(behaviour.get("delay", 0))
+            if "error" in behaviour:
+                raise behaviour["error"]
+            return reply(model)
+        if "error" in behaviour:
+            raise behaviour["error"]
+
+        def parts():
+            try:
+                time.sleep(behaviour.get("delay", 0))
+                for token in (model, " done"):
+                    yield chunk(token)
+                    time.sleep(0.05)
+            finally:
+                self.closed.add(TextModel(model))
+
+        return parts()
+
+    async def acompletion(self, model: str, messages: list, stream: bool = False):
+        behaviour = self._start(model, messages)
+        await asyncio.sleep(behaviour.get("delay", 0))
+        if "error" in behaviour:
+            raise behaviour["error"]
+        if not stream:
+            return reply(model)
+
+        async def parts():
+            try:
+                for token in (model, " done"):
+                    yield chunk(token)
+                    await asyncio.sleep(0.05)
+            finally:
+                self.closed.add(TextModel(model))
+
+        return parts()
+
+
+@pytest.fixture(autouse=True)
+def quick_hedge(monkeypatch):
+    monkeypatch.setattr(model_router, "HEDGE_MAX_S", HEDGE_AFTER_S)
+    monkeypatch.setattr(model_router, "HEDGE_MIN_S", HEDGE_AFTER_S)
+
+
+def make_router(provider: FakeProvider, hedge: bool = True) -> ModelRouter:
+    return ModelRouter(provider.completion, provider.acompletion, hedge=hedge)
+
+
+def text_of(parts) -> str:
+    return "".join(part.choices[0].delta.content for part in parts)
+
+
+def wait_for(condition, timeout: float = 2.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_fast_primary_streams_without_hedging():
+    provider = FakeProvider(**{PRIMARY.value: {}, FALLBACK.value: {}})
+    routed = make_router(provider).stream(PRIMARY, MESSAGES)
+
+    assert text_of(routed) == f"{PRIMARY.value} done"
+    assert routed.model is PRIMARY
+    assert provider.called() == [PRIMARY]
+
+
+def test_hedge_starts_after_delay_and_overtakes_slow_primary():
+    provider = FakeProvider(**{PRIMARY.value: {"delay": 1.0}, FALLBACK.value: {}})
+    router = make_router(provider)
+    start = time.monotonic()
+    routed = router.stream(PRIMARY, MESSAGES)
+
+    assert text_of(routed) == f"{FALLBACK.value} done"
+    assert routed.model is FALLBACK
+    assert time.monotonic() - start < 0.8
+    (_, primary_at, _), (_, hedge_at, _) = provider.calls
+    assert hedge_at - primary_at >= HEDGE_AFTER_S
+
+
+def test_loser_is_abandoned():
+    provider = FakeProvider(**{PRIMARY.value: {"delay": 0.5}, FALLBACK.value: {}})
+    router = make_router(provider)
+
+    assert text_of(router.stream(PRIMARY, MESSAGES)) == f"{FALLBACK.value} done"
+    # The slow stream is closed on its next chunk, and counted as hedged out
+    assert wait_for(lambda: PRIMARY in provider.closed)
+    assert wait_for(lambda: router.stats()[PRIMARY.value]["hedged_out"] == 1)
+    assert router.stats()[PRIMARY.value]["requests"] == 0
+
+
+def test_no_hedge_when_disabled():
+    provider = FakeProvider(**{PRIMARY.value: {"delay": 0.4}, FALLBACK.value: {}})
+    routed = make_router(provider, hedge=False).stream(PRIMARY, MESSAGES)
+
+    assert text_of(routed) == f"{PRIMARY.value} done"
+    assert provider.called() == [PRIMARY]
+
+
+def test_stream_falls_back_on_error_with_portable_messages():
+    provider = FakeProvider(
+        **{PRIMARY.value: {"error": RuntimeError("overloaded")}, FALLBACK.value: {}}
+    )
+    routed = make_router(provider).stream(PRIMARY, MESSAGES)
+
+    assert text_of(routed) == f"{FALLBACK.value} done"
+    assert routed.model is FALLBACK
+    (_, _, primary_messages), (_, _, fallback_messages) = provider.calls
+    assert primary_messages == MESSAGES
+    assert fallback_messages == [{"role": "user", "content": "hi"}]
+
+
+def test_stream_raises_when_every_candidate_fails():
+    provider = FakeProvider(
+        **{
+            PRIMARY.value: {"error": RuntimeError("primary down")},
+            FALLBACK.value: {"error": RuntimeError("fallback down")},
+        }
+    )
+    with pytest.raises(RuntimeError, match="fallback down"):
+        text_of(make_router(provider).stream(PRIMARY, MESSAGES))
+    assert provider.called() == [PRIMARY, FALLBACK]
+
+
+def test_complete_falls_back_on_error():
+    provider = FakeProvider(
+        **{PRIMARY.value: {"error": RuntimeError("overloaded")}, FALLBACK.value: {}}
+    )
+    router = make_router(provider)
+    model, response = router.complete(PRIMARY, MESSAGES)
+
+    assert model is FALLBACK
+    assert response.choices[0].message.content == FALLBACK.value
+    assert router.stats()[PRIMARY.value]["errors"] == 1
+
+
+def test_astream_hedges_slow_primary():
+    provider = FakeProvider(**{PRIMARY.value: {"delay": 1.0}, FALLBACK.value: {}})
+    router = make_router(provider)
+
+    async def run():
+        routed = router.astream(PRIMARY, MESSAGES)
+        parts = [part async for part in routed]
+        return routed.model, text_of(parts)
+
+    start = time.monotonic()
+    assert asyncio.run(run()) == (FALLBACK, f"{FALLBACK.value} done")
+    # The abandoned primary is cancelled rather than awaited
+    assert time.monotonic() - start < 0.8
+
+
+def test_acomplete_falls_back_on_error():
+    provider = FakeProvider(
+        **{PRIMARY.value: {"error": RuntimeError("overloaded")}, FALLBACK.value: {}}
+    )
+    model, _ = asyncio.run(make_router(provider).acomplete(PRIMARY, MESSAGES))
+    assert model is FALLBACK
+
+
+def test_candidates_skip_fallback_too_small_for_prompt():
+    router = make_router(FakeProvider())
+
+    assert router.candidates(PRIMARY, prompt_budget(FALLBACK)) == [PRIMARY, FALLBACK]
+    assert router.candidates(PRIMARY, prompt_budget(FALLBACK) + 1) == [PRIMARY]
+    assert router.candidates(TextModel.O1_PREVIEW) == [TextModel.O1_PREVIEW]
+
+
+def test_candidates_put_failing_primary_second():
+    provider = FakeProvider(
+        **{PRIMARY.value: {"error": RuntimeError("down")}, FALLBACK.value: {}}
+    )
+    router = make_router(provider)
+    for _ in range(model_router.MIN_SAMPLES):
+        router.complete(PRIMARY, MESSAGES)
+
+    assert router.candidates(PRIMARY) == [FALLBACK, PRIMARY]
@@ -0,0 +1,127 @@
+import json
+import logging
+from dataclasses import dataclass, field
+
+import s3_cache
+from messages import ChatMessage, ChatRole
+
+logger = logging.getLogger(__name__)
+CACHE_NAMESPACE = "transcripts"
+s3_cache.set_max_size(CACHE_NAMESPACE, 500)
+s3_cache.set_remote_only(CACHE_NAMESPACE)
+TRANSCRIPT_VERSION = 1
+# Same window as a full conversations_history fetch
+MAX_MESSAGES = 50
+
+
+def ts_key(ts: str) -> tuple[int, ...]:
+    """Sort key for Slack timestamps, which don't survive a round trip through float."""
+    return tuple(int(part) for part in ts.split("."))
+
+
+@dataclass
+class Transcript:
+    """
+    The processed history of a channel, oldest first, as of the newest Slack
+    message it covers.
+
+    :param message_ts: Timestamps of the Slack messages covered, oldest first.
+    :param entries: (ts, message) pairs after enrichment, before merging.
+    :param commands: (ts, text) pairs for the commands seen since the last reset.
+    :param deferred_pops: Commands at the newest end whose response hasn't been
+        posted yet. Each one drops the oldest entry of the next batch, exactly as a
+        full reprocessing of the channel would.
+    """
+
+    message_ts: list[str] = field(default_factory=list)
+    entries: list[tuple[str, ChatMessage]] = field(default_factory=list)
+    commands: list[tuple[str, str]] = field(default_factory=list)
+    deferred_pops: int = 0
+
+    @property
+    def newest_ts(self) -> str | None:
+        return self.message_ts[-1] if self.message_ts else None
+
+    def trim(self, max_messages: int = MAX_MESSAGES) -> None:
+        """Keep only what the newest `max_messages` Slack messages contributed."""
+        if len(self.message_ts) <= max_messages:
+            return
+        self.message_ts = self.message_ts[-max_messages:]
+        cutoff = ts_key(self.message_ts[0])
+        self.entries = [(ts, m) for ts, m in self.entries if ts_key(ts) >= cutoff]
+        self.commands = [(ts, c) for ts, c in self.commands if ts_key(ts) >= cutoff]
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "version": TRANSCRIPT_VERSION,
+                "message_ts": self.message_ts,
+                "entries": [
+                    {"ts": ts, "role": msg.role.value, "content": msg.content}
+                    for ts, msg in self.entries
+                ],
+                "commands": [{"ts": ts, "text": text} for ts, text in self.commands],
+                "deferred_pops": self.deferred_pops,
+            }
+        )
+
+    @classmethod
+    def from_json(cls, data: str) -> "Transcript":
+        record = json.loads(data)
+        if record.get("version") != TRANSCRIPT_VERSION:
+            raise ValueError(f"Unsupported transcript version {record.get('version')}")
+        return cls(
+            message_ts=record["message_ts"],
+            entries=[
+                (e["ts"], ChatMessage(e["content"], ChatRole(e["role"]), None))
+                for e in record["entries"]
+            ],
+            commands=[(c["ts"], c["text"]) for c in record["commands"]],
+            deferred_pops=record["deferred_pops"],
+        )
+
+
+def load(channel_id: str) -> Transcript | None:
+    data = s3_cache.get_cache(CACHE_NAMESPACE, channel_id)
+    if not data:
+        return None
+    try:
+        return Transcript.from_json(data)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f"Discarding unreadable transcript for [{channel_id}]: {e}")
+        return None
+
+
+def save(channel_id: str, transcript: Transcript) -> None:
+    s3_cache.set_cache(CACHE_NAMESPACE, channel_id, transcript.to_json())
+
+
+def alters_history(event: dict) -> bool:
+    """
+    Whether a `message_changed` or `message_deleted` event changes what a stored
+    transcript holds. The bot's own messages are handled when their stream ends, and
+    Slack also sends `message_changed` when it unfurls a link, with the text as is.
+    """
+    message = event.get("message") or {}
+    previous = event.get("previous_message") or {}
+    if (message or previous).get("bot_id"):
+        return False
+    if event.get("subtype") == "message_deleted":
+        return True
+    return bool(message.get("edited")) or message.get("text") != previous.get("text")
+
+
+def invalidate(channel_id: str) -> None:
+    logger.info(f"Invalidating stored transcript for [{channel_id}].")
+    s3_cache.delete_cache(CACHE_NAMESPACE, channel_id)
+
+
+def invalidate_if_covers(channel_id: str, ts: str) -> None:
+    """Drop the stored transcript if it already includes the message at `ts`."""
+    transcript = load(channel_id)
+    if (
+        transcript
+        and transcript.newest_ts
+        and ts_key(ts) <= ts_key(transcript.newest_ts)
+    ):
+        invalidate(channel_id)
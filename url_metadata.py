@@ -0,0 +1,81 @@
+import json
+import logging
+import time
+from dataclasses import asdict, dataclass
+
+import requests  # type: ignore
+
+import fetcher
+import s3_cache
+import telemetry
+
+logger = logging.getLogger(__name__)
+CACHE_NAMESPACE = "url_metadata"
+s3_cache.set_max_size(CACHE_NAMESPACE, 2000)
+TTL_S = 7 * 24 * 60 * 60
+# Failures are rechecked sooner, in case the site was only briefly unreachable
+NEGATIVE_TTL_S = 60 * 60
+HEAD_TIMEOUT_S = 5
+
+
+@dataclass
+class UrlMetadata:
+    """What a HEAD request told us about a URL, or why it couldn't."""
+
+    content_type: str = "unknown"
+    final_url: str | None = None
+    content_length: int | None = None
+    etag: str | None = None
+    error: str | None = None
+    fetched_at: float = 0.0
+
+    def is_expired(self) -> bool:
+        ttl = NEGATIVE_TTL_S if self.error else TTL_S
+        return time.time() - self.fetched_at > ttl
+
+
+def head_url(url: str) -> UrlMetadata:
+    """Send a HEAD request for `url`, following redirects."""
+    now = time.time()
+    try:
+        with telemetry.span("HeadLatency"):
+            response = fetcher.head(url, HEAD_TIMEOUT_S, allow_redirects=True)
+    except requests.exceptions.Timeout:
+        return UrlMetadata(error="timeout", fetched_at=now)
+    except requests.exceptions.RequestException as e:
+        return UrlMetadata(error=type(e).__name__, fetched_at=now)
+
+    error = None
+    if response.status_code in (405, 501):
+        error = "head-not-supported"
+    elif response.status_code >= 400:
+        error = f"http-{response.status_code}"
+    content_length = response.headers.get("Content-Length")
+    return UrlMetadata(
+        content_type=response.headers.get("Content-Type", "unknown"),
+        final_url=response.url,
+        content_length=(
+            int(content_length) if content_length and content_length.isdigit() else None
+        ),
+        etag=response.headers.get("ETag"),
+        error=error,
+        fetched_at=now,
+    )
+
+
+def get_url_metadata(url: str) -> UrlMetadata:
+    """Return metadata for `url`, only sending a HEAD request when the cache is stale."""
+    cached = s3_cache.get_cache(CACHE_NAMESPACE, url)
+    if cached:
+        try:
+            metadata = UrlMetadata(**json.loads(cached))
+            if not metadata.is_expired():
+                return metadata
+        except (ValueError, TypeError):
+            logger.error(f"Ignoring malformed metadata cached for [{url}].")
+
+    metadata = head_url(url)
+    if metadata.error:
+        logger.info(f"HEAD [{url}] failed: {metadata.error}.")
+    s3_cache.set_cache(CACHE_NAMESPACE, url, json.dumps(asdict(metadata)))
+    return metadata
@@ -1,14 +1,20 @@
 import logging
+import os
 from typing import Union
 
-import trafilatura  # type: ignore
-
+import freshness
 import s3_cache
+from fetcher import fetch_bytes
 
 logger = logging.getLogger(__name__)
 MAX_RESULT_LENGTH_CHAR = 1000 * 4 * 100  # roughly 100k tokens
+# Same cap as trafilatura.fetch_url
+MAX_PAGE_BYTES = 20 * 1000 * 1000
+PAGE_DEADLINE_S = float(os.environ.get("WEB_READER_DEADLINE_S", 10))
 CACHE_NAMESPACE = "web_reader"
 s3_cache.set_max_size(CACHE_NAMESPACE, 150)
+# Pages change, but rarely within hours; popular links never wait on a refetch
+freshness.set_policy(CACHE_NAMESPACE, ttl_s=6 * 60 * 60, stale_s=7 * 24 * 60 * 60)
 
 
 def page_result(text: str, cursor: int, max_length: int) -> str:
@@ -18,8 +24,10 @@ def page_result(text: str, cursor: int, max_length: int) -> str:
 
 def get_url(url: str) -> str:
     """Fetch URL and return the contents as a string."""
-    downloaded = trafilatura.fetch_url(url)
-    if downloaded is None:
+    import trafilatura  # type: ignore  # Heavy; only loaded once a link is read
+
+    downloaded = fetch_bytes(url, max_bytes=MAX_PAGE_BYTES, deadline_s=PAGE_DEADLINE_S)
+    if not downloaded:
         raise ValueError("Could not download article.")
     return (
         trafilatura.extract(downloaded, include_links=True, include_tables=True)
@@ -27,22 +35,18 @@ def get_url(url: str) -> str:
     )
 
 
-def scrape_text(url: str) -> Union[str, None]:
-    try:
-        cached_content = s3_cache.get_cache(CACHE_NAMESPACE, url)
-        if cached_content:
-            return cached_content
+def read_page(url: str) -> str:
+    page_contents = get_url(url)
+    if len(page_contents) > MAX_RESULT_LENGTH_CHAR:
+        page_contents = (
+            page_result(page_contents, 0, MAX_RESULT_LENGTH_CHAR) + " ... <truncated>"
+        )
+    return page_contents
 
-        page_contents = get_url(url)
 
-        if len(page_contents) > MAX_RESULT_LENGTH_CHAR:
-            page_contents = (
-                page_result(page_contents, 0, MAX_RESULT_LENGTH_CHAR)
-                + " ... <truncated>"
-            )
-
-        s3_cache.set_cache(CACHE_NAMESPACE, url, page_contents)
-        return page_contents
+def scrape_text(url: str) -> Union[str, None]:
+    try:
+        return freshness.get_or_refresh(CACHE_NAMESPACE, url, lambda: read_page(url))
     except Exception as e:
         logger.error(f"Failed to read article from [{url}].")
         return None
@@ -1,14 +1,30 @@
+import json
 import logging
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 
-from youtube_transcript_api import YouTubeTranscriptApi  # type: ignore
-
+import freshness
 import s3_cache
+from context_packer import count_tokens
 
 logger = logging.getLogger(__name__)
+# Captions are cached by video id, so every URL form of a video shares an entry
 CACHE_NAMESPACE = "ytsubs"
 s3_cache.set_max_size(CACHE_NAMESPACE, 200)
+# Any of the standard, shortened, embedded or live URL forms, in one pass
+VIDEO_URL = re.compile(
+    r"(?:youtube\.com/(?:embed|live)/|youtu\.be/|youtube\.com.*?[?&]v=)([\w-]+)"
+)
+# Per-segment timestamps for transcripts that fit, else one per 30s or 60s window
+RENDER_WINDOWS_S = (None, 30, 60)
+MAX_TRANSCRIPT_TOKENS = 8000
+# youtube_transcript_api takes no timeout, so calls are waited on with one instead
+TRANSCRIPT_DEADLINE_S = float(os.environ.get("YT_TRANSCRIPT_DEADLINE_S", 10))
+_transcript_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ytsubs")
+# Transcripts hardly ever change once published
+freshness.set_policy(CACHE_NAMESPACE, ttl_s=7 * 24 * 60 * 60, stale_s=30 * 24 * 60 * 60)
 
 
 def is_youtube_video(url):
@@ -19,47 +35,73 @@ def extract_video_id(url):
     """
     Function to extract the video id from a YouTube URL.
     """
+    match = VIDEO_URL.search(url)
+    return match.group(1) if match else None
+
+
+def fetch_segments(video_id: str) -> Union[str, None]:
+    """Fetch the captions of a video as JSON `[[start, text], ...]`."""
+    from youtube_transcript_api import YouTubeTranscriptApi  # type: ignore
+
+    # Raises TimeoutError past the deadline; the abandoned call finishes on its own
+    transcript = _transcript_executor.submit(
+        YouTubeTranscriptApi.get_transcript, video_id
+    ).result(timeout=TRANSCRIPT_DEADLINE_S)
+    if not transcript:
+        return None
+    return json.dumps(
+        [[round(segment["start"], 2), segment["text"]] for segment in transcript],
+        separators=(",", ":"),
+    )
+
 
-    # Standard YouTube URLs (e.g., "https://www.youtube.com/watch?v=dQw4w9WgXcQ")
-    match = re.search(r"youtube\.com.*v=([^&]*)", url)
-    if match:
-        return match.group(1)
+def _timestamp(seconds: float) -> str:
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{secs:02}" if hours else f"{minutes}:{secs:02}"
 
-    # Shortened YouTube URLs (e.g., "https://youtu.be/dQw4w9WgXcQ")
-    match = re.search(r"youtu\.be/([^?/]*)", url)
-    if match:
-        return match.group(1)
 
-    # Embedded YouTube URLs (e.g., "https://www.youtube.com/embed/dQw4w9WgXcQ")
-    match = re.search(r"youtube\.com/embed/([^?/]*)", url)
-    if match:
-        return match.group(1)
+def render_segments(segments: list, window_s: int | None = None) -> str:
+    """
+    Render captions with a timestamp on every segment, or, given `window_s`, merge
+    them into one line per window of that many seconds.
+    """
+    if window_s is None:
+        return " ".join(f"[{start:.2f}] {text}" for start, text in segments)
+    lines: list[str] = []
+    window_end = None
+    for start, text in segments:
+        if window_end is None or start >= window_end:
+            window_end = (start // window_s + 1) * window_s
+            lines.append(f"[{_timestamp(start)}] {text}")
+        else:
+            lines[-1] += f" {text}"
+    return "\n".join(lines)
 
-    # Live YouTube URLs (e.g., "https://www.youtube.com/live/dQw4w9WgXcQ")
-    match = re.search(r"youtube\.com/live/([^?/]*)", url)
-    if match:
-        return match.group(1)
 
-    return None
+def render_transcript(segments: list, max_tokens: int) -> str:
+    """Use the most detailed rendering that fits in `max_tokens`."""
+    for window_s in RENDER_WINDOWS_S:
+        transcript = render_segments(segments, window_s)
+        if count_tokens(transcript) <= max_tokens:
+            break
+    return transcript
 
 
-def yt_transcript(url: str) -> Union[str, None]:
+def yt_transcript(
+    url: str, max_tokens: int = MAX_TRANSCRIPT_TOKENS
+) -> Union[str, None]:
     """Function to fetch the transcript of a YouTube video, given the URL."""
-    cached_transcript = s3_cache.get_cache(CACHE_NAMESPACE, url)
-    if cached_transcript:
-        return cached_transcript
+    video_id = extract_video_id(url)
+    if not video_id:
+        return "<empty>"
     try:
-        video_id = extract_video_id(url)
-        if video_id:
-            transcript = YouTubeTranscriptApi.get_transcript(video_id)
-            if transcript:
-                transcript = " ".join(
-                    f"[{segment['start']:.2f}] {segment['text']}"
-                    for segment in transcript
-                )
-                s3_cache.set_cache(CACHE_NAMESPACE, url, transcript)
-                return transcript
+        segments = freshness.get_or_refresh(
+            CACHE_NAMESPACE, video_id, lambda: fetch_segments(video_id)
+        )
     except Exception as e:
         logger.error(f"Failed to extract transcript for [{url}].")
         return None
-    return "<empty>"
+    if not segments:
+        return "<empty>"
+    return render_transcript(json.loads(segments), max_tokens)